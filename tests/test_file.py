@@ -2,6 +2,8 @@ import unittest
 import os
 import hashlib
 import sys
+import socket
+import time
 from pathlib import Path
 # Add parent directory to sys.path to make 'torrentula' package importable
 current_dir = os.path.dirname(__file__)
@@ -103,6 +105,140 @@ class TestFile(unittest.TestCase):
         newly_completed = self.file.update_bitfield()
         self.assertEqual(self.file.bytes_downloaded(), PIECE_LENGTH + 12345)
 
+    def test_unverified_progress(self):
+        """Test that the unverified byte count follows blocks as they are added and discarded."""
+        piece = self.file.pieces[2]
+        piece.add_block(0, bytes(16 * 1024))
+        self.file.update_bitfield()
+        self.assertEqual(self.file.bytes_downloaded_unverified(), 16 * 1024)
+        self.assertEqual(self.file.bytes_left_unverified(), FILE_LENGTH - 16 * 1024)
+        piece.reset()
+        self.file.update_bitfield()
+        self.assertEqual(self.file.bytes_downloaded_unverified(), 0)
+        self.assertEqual(self.file.bytes_downloaded(), 0)
+
+    def test_memory_budget(self):
+        """Test that partially downloaded pieces are tracked and counted against the memory budget."""
+        self.file.buffers.budget = PIECE_LENGTH
+        self.file.pieces[2].add_block(0, bytes(16 * 1024))
+        self.file.update_bitfield()
+        self.assertEqual(self.file.in_progress_pieces(), {2})
+        self.assertEqual(self.file.bytes_in_flight(), PIECE_LENGTH)
+        self.assertTrue(self.file.buffers.exhausted())
+        self.file.pieces[2].reset()
+        self.file.update_bitfield()
+        self.assertEqual(self.file.in_progress_pieces(), set())
+        self.assertFalse(self.file.buffers.exhausted())
+
+    def test_startable_pieces(self):
+        """Test that pieces assigned to peers count against the memory budget before their first block arrives."""
+        self.file.buffers.budget = 3 * PIECE_LENGTH
+        self.assertEqual(self.file.startable_pieces(set()), 3)
+        self.assertEqual(self.file.startable_pieces({0, 1}), 1)
+        self.file.pieces[2].add_block(0, bytes(16 * 1024))
+        self.assertEqual(self.file.startable_pieces({0, 1, 2}), 0)
+
+    def test_read_cache(self):
+        """Test that verified pieces are read ahead into the cache and evicted least recently used first."""
+        self.file.pieces[0].storage.write(0, bytes(range(256)) * 256)
+        self.file.pieces[0].complete = True
+        self.file.update_bitfield()
+        self.assertEqual(bytes(self.file.get_data_from_piece(256, 16, 0)), bytes(range(16)))
+        self.assertEqual(self.file.cache.misses, 1)
+        self.assertEqual(bytes(self.file.get_data_from_piece(16, 16, 0)), bytes(range(16, 32)))
+        self.assertEqual(self.file.cache.hits, 1)  # The rest of the piece was read ahead.
+        cache = torrentula.PieceCache(2 * PIECE_LENGTH)
+        for index in range(3):
+            cache.insert(index, bytes(PIECE_LENGTH))
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(cache.size, 2 * PIECE_LENGTH)
+
+    def test_cache_recycles_buffers(self):
+        """Test that piece buffers evicted from the read cache are returned to the buffer pool."""
+        pool = torrentula.BufferPool(PIECE_LENGTH)
+        cache = torrentula.PieceCache(PIECE_LENGTH, pool)
+        buffer = bytearray(PIECE_LENGTH)
+        cache.insert(0, buffer)
+        cache.insert(1, bytearray(PIECE_LENGTH))
+        self.assertIs(pool.acquire(PIECE_LENGTH), buffer)
+        cache.insert(2, bytes(PIECE_LENGTH))  # Data read from storage is not pooled.
+        self.assertEqual(len(pool.free), 1)
+
+    def test_page_cache_hints(self):
+        """Test that requested pieces are read ahead once and served pieces beyond the budget are dropped, oldest first."""
+        hints = torrentula.PageCacheHints(2 * PIECE_LENGTH)
+        self.assertTrue(hints.prefetch(0))
+        self.assertFalse(hints.prefetch(0))
+        self.assertEqual(hints.finished(0, PIECE_LENGTH), [])
+        self.assertEqual(hints.finished(1, PIECE_LENGTH), [])
+        self.assertEqual(hints.finished(0, PIECE_LENGTH), [])  # Served again, now the most recent.
+        self.assertEqual(hints.finished(2, PIECE_LENGTH), [1])
+        self.assertTrue(hints.prefetch(1))  # Dropped, so read ahead again when requested.
+        self.file.pieces[0].complete = True
+        self.file.update_bitfield()
+        self.file.hints.budget = 0
+        self.file.prefetch_piece(0)
+        self.file.finished_serving(0)
+        self.assertEqual(self.file.hints.dropped, 1)
+
+    def test_zero_copy_upload(self):
+        """Test that uncached pieces are sent from storage with sendfile and cached ones with sendmsg."""
+        data = bytes(range(256)) * 256
+        self.file.pieces[0].storage.write(0, data)
+        self.file.pieces[0].complete = True
+        self.file.update_bitfield()
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            self.file.cache.budget = 0
+            sender.setblocking(False)
+            queue = torrentula.SendQueue()
+            region = self.file.get_data_from_piece(100, 1000, 0)
+            self.assertIsInstance(region, torrentula.StorageRegion)
+            queue.send(sender, [b"head", region])
+            self.assertEqual(receiver.recv(2000), b"head" + data[100:1100])
+            self.file.cache.budget = PIECE_LENGTH
+            view = self.file.get_data_from_piece(100, 1000, 0)
+            self.assertIsInstance(view, memoryview)
+            queue.send(sender, [b"head", view])
+            self.assertEqual(receiver.recv(2000), b"head" + data[100:1100])
+            self.assertEqual(queue.size, 0)
+
+    def test_upload_outlives_storage(self):
+        """Test that a region queued for upload is still sent correctly after its storage is closed and its fd reused."""
+        data = bytes(range(256)) * 256
+        self.file.pieces[0].storage.write(0, data)
+        self.file.pieces[0].complete = True
+        self.file.update_bitfield()
+        self.file.cache.budget = 0
+        region = self.file.get_data_from_piece(100, 1000, 0)
+        self.file.close_file()
+        fd = os.open(self.file.bitfield_path, os.O_RDONLY)
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            sender.setblocking(False)
+            queue = torrentula.SendQueue()
+            queue.send(sender, [region])
+            self.assertEqual(receiver.recv(2000), data[100:1100])
+        os.close(fd)
+
+    def test_send_queue(self):
+        """Test that data a socket does not accept at once is queued and sent in order by later flushes, without blocking."""
+        data = bytes(range(256)) * 2**14  # 4 MB, more than a socket buffer holds
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            sender.setblocking(False)
+            queue = torrentula.SendQueue()
+            queue.send(sender, [b"head", data])
+            queue.send(sender, [b"tail"])
+            self.assertGreater(queue.size, 0)
+            received = bytearray()
+            while len(received) < len(data) + 8:
+                received += receiver.recv(2**20)
+                queue.flush(sender)
+            self.assertEqual(bytes(received), b"head" + data + b"tail")
+            self.assertTrue(queue.flush(sender))
+            self.assertEqual(queue.stalled_for(), 0)
+
     def test_complete(self):
         """Test that file completeness is correctly detected."""
         # Initially, file is not complete
@@ -114,6 +250,33 @@ class TestFile(unittest.TestCase):
         newly_completed = self.file.update_bitfield()
         self.assertTrue(self.file.complete())
 
+    def test_priorities(self):
+        """Test that skipped ranges are never wanted and that the file is complete once the wanted pieces are downloaded."""
+        self.file.set_priority(0, 2 * PIECE_LENGTH + 10, "skip")
+        self.assertEqual(self.file.missing_pieces(), {2, 3, 4, 5})  # Piece 2 still holds wanted data.
+        self.file.set_priority(4 * PIECE_LENGTH, FILE_LENGTH, "high")
+        self.assertEqual(self.file.priority_tiers(), [{4, 5}, {2, 3}])
+        for index in (2, 3, 4, 5):
+            self.file.pieces[index].complete = True
+        self.file.update_bitfield()
+        self.assertTrue(self.file.complete())
+        self.assertFalse(self.file.has_all_pieces())
+        self.assertEqual(torrentula.parse_priority_range("low:10-"), ("low", 10, None))
+
+    def test_seed_partial_download(self):
+        """Test that a download finished with skipped pieces is seeded with the pieces it has instead of claiming all of them."""
+        self.file.set_priority(0, PIECE_LENGTH, "skip")
+        for piece in self.file.pieces[1:]:
+            piece.complete = True
+        self.file.update_bitfield()
+        self.assertTrue(self.file.complete())
+        self.file.close_file()
+        self.file.write_bitfield_to_disk()
+        self.file.seed_file()
+        self.assertEqual(self.file.bitfield, [0, 1, 1, 1, 1, 1])
+        self.assertEqual(self.file.load_bitfield_from_disk(), [0, 1, 1, 1, 1, 1])
+        self.file.close_file()
+
     def test_bitfield_disk_operations(self):
         """Test saving and loading the bitfield to/from disk."""
         # Update the bitfield to simulate progress
@@ -128,6 +291,169 @@ class TestFile(unittest.TestCase):
         loaded_bitfield = self.file.load_bitfield_from_disk()
         self.assertEqual(loaded_bitfield, [1, 0, 0, 0, 0, 0])
 
+    def test_resume_file_synced(self):
+        """Test that the data is synced to disk before the resume file records the pieces it holds."""
+        synced = []
+        self.file.storage.flush = lambda: synced.append(self.file.bitfield_path.read_bytes())
+        self.file.pieces[0].complete = True
+        self.file.update_bitfield()
+        self.file.write_bitfield_to_disk()
+        self.assertEqual(len(synced), 1)
+        self.assertNotEqual(synced[0], self.file.bitfield_path.read_bytes())  # Synced while the resume file did not record piece 0 yet.
+
+    def test_resume_file_stale(self):
+        """Test that progress is rechecked when the data changed after the resume file was written."""
+        self.file.pieces[0].complete = True
+        self.file.update_bitfield()
+        self.file.write_bitfield_to_disk()
+        self.file.close_file()
+        with open(self.file.bitfield_path, "rb") as f:
+            self.assertTrue(f.read().startswith(b"TRNT"))
+        stat = os.stat(self.file.torrent_path)
+        os.utime(self.file.torrent_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.file = torrentula.File("test_file", self.destination, FILE_LENGTH, PIECE_LENGTH, HASHES)
+        self.assertTrue(self.file.stale)
+        self.assertEqual(self.file.bitfield, [0] * 6)  # The recheck found that piece 0 does not match its hash.
+
+    def test_partial_piece_journal(self):
+        """Test that blocks of unfinished pieces survive a restart and only the missing blocks are requested again."""
+        data = bytes(range(256)) * 256
+        hashes = [hashlib.sha1(data).digest()] + HASHES[1:]
+        self.file.close_file()
+        self.file = torrentula.File("test_file", self.destination, FILE_LENGTH, PIECE_LENGTH, hashes, disk_workers=0, hash_workers=0)
+        block = 16 * 1024
+        for offset in (0, 2 * block):
+            self.file.pieces[0].add_block(offset, data[offset : offset + block])
+        self.file.close_file()
+        self.file = torrentula.File("test_file", self.destination, FILE_LENGTH, PIECE_LENGTH, hashes, disk_workers=0, hash_workers=0)
+        self.assertFalse(self.file.stale)
+        piece = self.file.pieces[0]
+        self.assertEqual(piece.downloaded, 2 * block)
+        self.assertEqual(self.file.in_progress_pieces(), {0})
+        self.assertEqual(piece.get_next_requests(4), [(block, block), (3 * block, block)])
+        for offset in (block, 3 * block):
+            piece.add_block(offset, data[offset : offset + block])
+        self.assertTrue(piece.complete)  # The restored blocks passed the hash check with the new ones.
+        self.file.update_bitfield()
+        self.file.write_bitfield_to_disk()
+        self.assertEqual(self.file.journal, {})
+
+    def test_scrubber(self):
+        """Test that the scrubber finds corrupt pieces, which are then marked missing and no longer uploaded."""
+        data = bytes(range(256)) * 256
+        hashes = [hashlib.sha1(data).digest()] + HASHES[1:]
+        self.file.close_file()
+        self.file = torrentula.File("test_file", self.destination, FILE_LENGTH, PIECE_LENGTH, hashes)
+        self.file.storage.write(0, data)
+        self.file.bitfield = [1] * 6
+        self.file.start_scrubber(1024)
+        deadline = time.monotonic() + 5
+        while self.file.scrubber.passes == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sorted(self.file.collect_scrub()), [1, 2, 3, 4, 5])
+        self.assertEqual(self.file.bitfield, [1, 0, 0, 0, 0, 0])
+        self.assertEqual(self.file.get_data_from_piece(0, 16, 1), 0)
+        self.assertGreater(self.file.scrubber.throughput(), 0)
+
+    def test_scrubber_idle(self):
+        """Test that a scrubber with no pieces to verify waits instead of counting empty passes."""
+        self.file.bitfield = [0] * 6
+        self.file.start_scrubber(1024)
+        time.sleep(0.2)
+        self.assertEqual(self.file.scrubber.passes, 0)
+        self.assertEqual(self.file.scrubber.position, 0)
+
+    def test_legacy_bitfield(self):
+        """Test that a bitfield written in the original text format is still loaded."""
+        self.file.close_file()
+        with open(self.file.bitfield_path, "w") as f:
+            f.write("100000")
+        self.file = torrentula.File("test_file", self.destination, FILE_LENGTH, PIECE_LENGTH, HASHES)
+        self.assertFalse(self.file.stale)
+        self.assertEqual(self.file.bitfield, [1, 0, 0, 0, 0, 0])
+
+    def test_mmap_storage(self):
+        """Test that mmap storage writes into the file and serves reads as memoryviews."""
+        self.file.close_file()
+        self.file = torrentula.File(
+            name="test_file",
+            destination=self.destination,
+            length=FILE_LENGTH,
+            piece_length=PIECE_LENGTH,
+            hashes=HASHES,
+            storage_mode="mmap",
+        )
+        data = bytes(range(256)) * 64  # 16 KB block
+        self.file.pieces[1].storage.write(PIECE_LENGTH, data)
+        served = self.file.get_data_from_piece(0, len(data), 1)
+        self.assertIsInstance(served, memoryview)
+        self.assertEqual(bytes(served), data)
+        served.release()
+        self.file.close_file()
+        with open(self.file.torrent_path, "rb") as f:
+            f.seek(PIECE_LENGTH)
+            self.assertEqual(f.read(len(data)), data)
+
+    def test_volatile_storage(self):
+        """Test that memory and null storage keep nothing on disk."""
+        self.file.close_file()
+        os.remove(self.file.torrent_path)
+        os.remove(self.file.bitfield_path)
+        data = bytes(range(256)) * 64  # 16 KB block
+        for mode, expected in (("memory", data), ("null", bytes(len(data)))):
+            self.file = torrentula.File(
+                name="test_file",
+                destination=self.destination,
+                length=FILE_LENGTH,
+                piece_length=PIECE_LENGTH,
+                hashes=HASHES,
+                storage_mode=mode,
+            )
+            self.file.pieces[1].storage.write(PIECE_LENGTH, data)
+            self.assertEqual(bytes(self.file.pieces[1].storage.read(PIECE_LENGTH, len(data))), expected, mode)
+            self.file.close_file()
+            self.assertFalse(os.path.exists(self.file.torrent_path), mode)
+            self.assertFalse(os.path.exists(self.file.bitfield_path), mode)
+
+    def test_import_content(self):
+        """Test that pieces found in an existing file are copied into the download, except for the ones that differ."""
+        data = bytes(i % 253 for i in range(FILE_LENGTH))
+        hashes = [hashlib.sha1(data[i : i + PIECE_LENGTH]).digest() for i in range(0, FILE_LENGTH, PIECE_LENGTH)]
+        candidate = os.path.join(self.destination, "previous_release")
+        with open(candidate, "wb") as f:
+            f.write(data[: 2 * PIECE_LENGTH] + bytes(PIECE_LENGTH) + data[3 * PIECE_LENGTH :])
+        self.file.close_file()
+        os.remove(self.file.torrent_path)
+        os.remove(self.file.bitfield_path)
+        self.file = torrentula.File(
+            name="test_file",
+            destination=self.destination,
+            length=FILE_LENGTH,
+            piece_length=PIECE_LENGTH,
+            hashes=hashes,
+            import_from=[self.destination],
+        )
+        os.remove(candidate)
+        self.assertEqual(self.file.bitfield, [1, 1, 0, 1, 1, 1])
+        self.assertEqual(self.file.missing_pieces(), {2})
+        self.assertEqual(bytes(self.file.storage.read(3 * PIECE_LENGTH, FILE_LENGTH - 3 * PIECE_LENGTH)), data[3 * PIECE_LENGTH :])
+
+    def test_preallocation_modes(self):
+        """Test that every preallocation mode sizes a new in-progress file to the torrent length."""
+        for mode in torrentula.PREALLOCATION_MODES:
+            self.file.close_file()
+            os.remove(self.file.torrent_path)
+            self.file = torrentula.File(
+                name="test_file",
+                destination=self.destination,
+                length=FILE_LENGTH,
+                piece_length=PIECE_LENGTH,
+                hashes=HASHES,
+                preallocation_mode=mode,
+            )
+            self.file.close_file()
+            self.assertEqual(os.path.getsize(self.file.torrent_path), FILE_LENGTH, mode)
+
     def test_remove_bitfield(self):
         """Test removing the bitfield file."""
         # Create the bitfield file
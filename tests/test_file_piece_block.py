@@ -5,6 +5,7 @@ import os
 import sys
 import unittest
 import filecmp
+from collections import deque
 
 # Add parent directory to sys.path to make 'torrentula' package importable
 current_dir = os.path.dirname(__file__)
@@ -31,13 +32,14 @@ class testPiece(unittest.TestCase):
         with open(TORRENT_PATH, "wb") as f:
             f.write(self.data)
         
-        f = open(ADD_PATH, "x")
-       
-        self.piece = torrentula.Piece(0, PIECE_LENGTH, HASH, PIECE_LENGTH, ADD_PATH)
+        open(ADD_PATH, "x").close()
+        self.storage = torrentula.FileStorage(ADD_PATH)
+        self.piece = torrentula.Piece(0, PIECE_LENGTH, HASH, PIECE_LENGTH, ADD_PATH, self.storage)
         print(f"Expected Piece Length: {PIECE_LENGTH}, Actual Data Length: {len(self.data)}")
 
     def tearDown(self):
         """Clean up test environment by removing the test file."""
+        self.storage.close()
         if os.path.exists(TORRENT_PATH):
             os.remove(TORRENT_PATH)
         if os.path.exists(ADD_PATH):
@@ -83,7 +85,7 @@ class testPiece(unittest.TestCase):
             f.write(data)
 
         # Create a new piece object with a smaller piece length
-        piece = torrentula.Piece(0, smaller_piece_length, hash, PIECE_LENGTH, ADD_PATH)
+        piece = torrentula.Piece(0, smaller_piece_length, hash, PIECE_LENGTH, ADD_PATH, self.storage)
 
         # Test adding blocks
         for offset in range(0, smaller_piece_length, BLOCK_SIZE):
@@ -106,6 +108,120 @@ class testPiece(unittest.TestCase):
         piece._write_to_disk()
         self.assertTrue(self.are_files_equal(TORRENT_PATH, ADD_PATH))
 
+    #test handing out blocks to request in batches
+    def test_request_batch(self):
+        """Blocks are handed out in batches, and requests that time out are handed out again."""
+        first = self.piece.get_next_requests(3)
+        self.assertEqual(first, [(0, BLOCK_SIZE), (BLOCK_SIZE, BLOCK_SIZE), (2 * BLOCK_SIZE, BLOCK_SIZE)])
+        self.assertEqual(self.piece.get_next_requests(3), [(3 * BLOCK_SIZE, BLOCK_SIZE)])
+        self.assertEqual(self.piece.get_next_requests(3), [])
+        self.piece.add_block(BLOCK_SIZE, self.data[BLOCK_SIZE : 2 * BLOCK_SIZE])
+        self.piece.pendingRequests = dict.fromkeys(self.piece.pendingRequests, 0)  # expire the outstanding requests
+        self.piece.timeouts = [(0, offset) for offset in self.piece.pendingRequests]
+        self.assertEqual(sorted(self.piece.get_next_requests(10)), [(0, BLOCK_SIZE), (2 * BLOCK_SIZE, BLOCK_SIZE), (3 * BLOCK_SIZE, BLOCK_SIZE)])
+        self.piece.endgame_mode = True
+        self.assertEqual(sorted(self.piece.get_next_requests(10)), [(0, BLOCK_SIZE), (2 * BLOCK_SIZE, BLOCK_SIZE), (3 * BLOCK_SIZE, BLOCK_SIZE)])
+
+    #test remembering which peers were asked for a block
+    def test_request_holders(self):
+        """Peers asked for a block are remembered until it arrives, so the rest can be sent a cancel."""
+        self.piece.endgame_mode = True
+        first, second = object(), object()
+        for peer in (first, second):
+            for offset, length in self.piece.get_next_requests(4):
+                self.piece.add_holder(offset, peer)
+        self.assertEqual(self.piece.take_holders(0), {first, second})
+        self.assertEqual(self.piece.take_holders(0), set())
+        self.piece.add_block(0, self.data[:BLOCK_SIZE])
+        self.assertEqual(self.piece.add_block(0, self.data[:BLOCK_SIZE]), -2)
+        self.piece.reset()
+        self.assertEqual(self.piece.holders, {})
+
+    #test blaming corrupt pieces on the peers that sent them
+    def test_hash_failure_blame(self):
+        """A corrupt piece is blamed on its only source, or on the peer whose block differs once a valid copy arrives, never on restored blocks."""
+        blame = deque()
+        piece = torrentula.Piece(0, PIECE_LENGTH, HASH, PIECE_LENGTH, ADD_PATH, self.storage, blame=blame)
+        corrupt = bytes(BLOCK_SIZE)
+        for offset in range(0, PIECE_LENGTH, BLOCK_SIZE):
+            piece.add_block(offset, corrupt if offset == BLOCK_SIZE else self.data[offset : offset + BLOCK_SIZE], "poisoner" if offset == BLOCK_SIZE else "honest")
+        self.assertEqual(piece.hash_failures, 1)
+        self.assertEqual(list(blame), [])  # two peers sent blocks, no way to tell yet
+        for offset in range(0, PIECE_LENGTH, BLOCK_SIZE):
+            piece.add_block(offset, self.data[offset : offset + BLOCK_SIZE], "trusted")
+        self.assertTrue(piece.complete)
+        self.assertEqual(list(blame), [(0, "poisoner")])
+        self.assertEqual(piece.failed_blocks, {})
+
+        piece.reset()
+        blame.clear()
+        for offset in range(0, PIECE_LENGTH, BLOCK_SIZE):
+            piece.add_block(offset, corrupt, "poisoner")
+        self.assertEqual(list(blame), [(0, "poisoner")])
+
+        piece.reset()
+        blame.clear()
+        self.storage.write(0, corrupt)  # a block restored from the journal is corrupt, not the peer's
+        piece.restore_blocks(bytes([1, 0, 0, 0]))
+        for offset in range(BLOCK_SIZE, PIECE_LENGTH, BLOCK_SIZE):
+            piece.add_block(offset, self.data[offset : offset + BLOCK_SIZE], "honest")
+        self.assertFalse(piece.complete)
+        for offset in range(0, PIECE_LENGTH, BLOCK_SIZE):
+            piece.add_block(offset, self.data[offset : offset + BLOCK_SIZE], "trusted")
+        self.assertTrue(piece.complete)
+        self.assertEqual(list(blame), [])
+
+    #test that pieces assemble into pooled buffers
+    def test_buffer_pool(self):
+        """Test that a stored piece returns its buffer to the pool and that duplicate blocks are rejected."""
+        pool = torrentula.BufferPool(PIECE_LENGTH)
+        piece = torrentula.Piece(0, PIECE_LENGTH, HASH, PIECE_LENGTH, ADD_PATH, self.storage, buffers=pool)
+        self.assertEqual(piece.add_block(0, memoryview(self.data)[:BLOCK_SIZE]), 1)
+        self.assertEqual(piece.add_block(0, memoryview(self.data)[:BLOCK_SIZE]), -2)
+        buffer = piece.pieceBuffer
+        for offset in range(BLOCK_SIZE, PIECE_LENGTH, BLOCK_SIZE):
+            piece.add_block(offset, memoryview(self.data)[offset:offset + BLOCK_SIZE])
+        self.assertTrue(piece.complete)
+        self.assertIsNone(piece.pieceBuffer)
+        self.assertTrue(self.are_files_equal(TORRENT_PATH, ADD_PATH))
+        self.assertIs(pool.acquire(PIECE_LENGTH), buffer)
+
+    #test hashing blocks as they arrive in order
+    def test_incremental_hash(self):
+        """Test that in order blocks are hashed as they arrive, so the piece is verified without the verifier pool."""
+        verifier = torrentula.PieceVerifier(workers=1)
+        piece = torrentula.Piece(0, PIECE_LENGTH, HASH, PIECE_LENGTH, ADD_PATH, self.storage, verifier=verifier)
+        piece.add_block(BLOCK_SIZE, self.data[BLOCK_SIZE:2 * BLOCK_SIZE])
+        self.assertEqual(piece.hashed, 0)
+        piece.add_block(0, self.data[:BLOCK_SIZE])
+        self.assertEqual(piece.hashed, 2 * BLOCK_SIZE)  # the out of order block was hashed once the gap was filled
+        for offset in range(2 * BLOCK_SIZE, PIECE_LENGTH, BLOCK_SIZE):
+            piece.add_block(offset, self.data[offset:offset + BLOCK_SIZE])
+        self.assertFalse(piece.verifying)
+        self.assertTrue(piece.stored())
+        self.assertEqual(verifier.queue_depth(), 0)
+        self.assertTrue(self.are_files_equal(TORRENT_PATH, ADD_PATH))
+        verifier.shutdown()
+
+    #test hashing on a verifier pool
+    def test_background_verification(self):
+        """Test that a piece hashed in the background is written when valid and reset when corrupt."""
+        verifier = torrentula.PieceVerifier(workers=1)
+        piece = torrentula.Piece(0, PIECE_LENGTH, HASH, PIECE_LENGTH, ADD_PATH, self.storage, verifier=verifier)
+        corrupt = b"x" + self.data[1:]
+        for attempt in (corrupt, self.data):
+            # out of order, so the running hash cannot finish before the last block and the rest is hashed by the verifier
+            for offset in reversed(range(0, PIECE_LENGTH, BLOCK_SIZE)):
+                piece.add_block(offset, attempt[offset:offset + BLOCK_SIZE])
+            self.assertTrue(piece.verifying)
+            verifier.wait()
+            for index, digest in verifier.collect():
+                piece.verification_finished(digest)
+            self.assertFalse(piece.verifying)
+        self.assertTrue(piece.stored())
+        self.assertTrue(self.are_files_equal(TORRENT_PATH, ADD_PATH))
+        verifier.shutdown()
+
 
 
 if __name__ == "__main__":
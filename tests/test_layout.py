@@ -0,0 +1,100 @@
+import unittest
+import os
+import shutil
+import hashlib
+from pathlib import Path
+from tests import torrentula
+
+PIECE_LENGTH = 16 * 1024
+FILES = [
+    (Path("a.txt"), 10000),
+    (Path("empty.txt"), 0),
+    (Path("sub", "b.bin"), 30000),
+    (Path("c.bin"), 5000),
+]
+LENGTH = sum(length for _, length in FILES)
+DATA = bytes(i % 251 for i in range(LENGTH))
+HASHES = [hashlib.sha1(DATA[i : i + PIECE_LENGTH]).digest() for i in range(0, LENGTH, PIECE_LENGTH)]
+
+
+class LayoutTests(unittest.TestCase):
+    """
+    Usage: python -m unittest discover
+    Will run any tests matching the pattern 'test*.py'
+    """
+
+    def setUp(self):
+        self.layout = torrentula.Layout.for_files(FILES, PIECE_LENGTH)
+
+    def test_spans_within_file(self):
+        self.assertEqual(self.layout.spans(100, 200), [(0, 100, 200)])
+
+    def test_spans_cross_files(self):
+        """A piece crossing a boundary is split, skipping zero-length files."""
+        self.assertEqual(self.layout.piece_spans(0, 0, PIECE_LENGTH), [(0, 0, 10000), (2, 0, PIECE_LENGTH - 10000)])
+        self.assertEqual(self.layout.spans(39000, 2000), [(2, 29000, 1000), (3, 0, 1000)])
+
+    def test_single_file(self):
+        layout = torrentula.Layout.for_single_file(LENGTH, PIECE_LENGTH)
+        self.assertFalse(layout.multi_file)
+        self.assertEqual(layout.paths(Path("x.part")), [Path("x.part")])
+        self.assertEqual(layout.spans(5, 10), [(0, 5, 10)])
+
+
+class MultiFileTests(unittest.TestCase):
+    def setUp(self):
+        self.destination = "test_multi_destination"
+        os.makedirs(self.destination, exist_ok=True)
+        self.file = torrentula.File("multi", self.destination, LENGTH, PIECE_LENGTH, HASHES, files=FILES)
+
+    def tearDown(self):
+        self.file.close_file()
+        shutil.rmtree(self.destination)
+
+    def test_files_created(self):
+        for (path, length), actual in zip(FILES, self.file.layout.paths(self.file.torrent_path)):
+            self.assertEqual(os.path.getsize(actual), length)
+
+    def test_pieces_written_across_files(self):
+        for piece in self.file.pieces:
+            start = piece.index * PIECE_LENGTH
+            for offset in range(0, piece.length, PIECE_LENGTH):
+                piece.add_block(offset, DATA[start + offset : start + offset + PIECE_LENGTH])
+            self.assertTrue(piece.complete)
+            self.assertFalse(piece.stored())  # Verified and written in the background, so not yet counted as downloaded.
+        self.file.flush()
+        self.assertTrue(self.file.complete())
+        self.assertEqual(bytes(self.file.get_data_from_piece(9000, 2000, 0)), DATA[9000:11000])
+        self.file.close_file()
+        self.file.rename(self.file.final_path)
+        contents = b"".join(Path(self.file.final_path, path).read_bytes() for path, _ in FILES)
+        self.assertEqual(contents, DATA)
+
+    def test_coalesced_writes(self):
+        """Adjacent queued pieces are stored by one vectored write, split across the files they cover."""
+        writer = torrentula.DiskWriter(self.file.storage, workers=1)
+        offsets = [2 * PIECE_LENGTH, 0, PIECE_LENGTH]
+        writer.queued = [(offset, offset // PIECE_LENGTH, bytearray(DATA[offset : offset + PIECE_LENGTH])) for offset in offsets]
+        writer.pending = len(offsets)
+        writer.write_queued()
+        writer.shutdown()
+        self.assertEqual(writer.coalesced, 2)
+        self.assertEqual(sorted(writer.collect()), [(0, None), (1, None), (2, None)])
+        self.assertEqual(bytes(self.file.storage.read(0, LENGTH)), DATA)
+
+    def test_recheck(self):
+        """Recheck rebuilds the bitfield from the data on disk, detecting corrupt pieces."""
+        self.file.storage.write(0, DATA)
+        self.file.close_file()
+        os.remove(self.file.bitfield_path)
+        self.file = torrentula.File("multi", self.destination, LENGTH, PIECE_LENGTH, HASHES, files=FILES, recheck="full")
+        self.assertTrue(self.file.complete())
+        self.file.storage.write(PIECE_LENGTH + 5, b"!")
+        self.file.close_file()
+        self.file = torrentula.File("multi", self.destination, LENGTH, PIECE_LENGTH, HASHES, files=FILES, recheck="quick")
+        self.assertEqual(self.file.bitfield, [1, 0, 1])
+        self.assertEqual(self.file.missing_pieces(), {1})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+import os
+import sys
+import shutil
+import signal
+import hashlib
+import bencoder
+from tests import torrentula
+
+PIECE_LENGTH = 16 * 1024
+LENGTH = PIECE_LENGTH * 3 + 1000
+DATA = bytes(i % 251 for i in range(LENGTH))
+HASHES = [hashlib.sha1(DATA[i : i + PIECE_LENGTH]).digest() for i in range(0, LENGTH, PIECE_LENGTH)]
+
+
+class SinkTests(unittest.TestCase):
+    """
+    Usage: python -m unittest discover
+    Will run any tests matching the pattern 'test*.py'
+    """
+
+    def setUp(self):
+        self.destination = "test_sink_destination"
+        os.makedirs(self.destination, exist_ok=True)
+        self.output = os.path.join(self.destination, "output")
+
+    def tearDown(self):
+        self.file.close_file()
+        shutil.rmtree(self.destination)
+
+    def add_piece(self, index):
+        start = index * PIECE_LENGTH
+        self.file.pieces[index].add_block(0, DATA[start : start + self.file.pieces[index].length])
+        self.file.update_bitfield()
+        return self.sink.advance()
+
+    def test_pieces_written_in_order(self):
+        """Pieces completed out of order reach the sink in order, and the download is kept on disk."""
+        self.file = torrentula.File("sink", self.destination, LENGTH, PIECE_LENGTH, HASHES, disk_workers=0)
+        self.sink = torrentula.OrderedSink(self.file, self.output)
+        self.assertEqual(self.add_piece(2), 0)
+        self.assertEqual(self.add_piece(0), 1)
+        self.assertEqual(self.add_piece(1), 2)
+        self.add_piece(3)
+        self.sink.finish()
+        with open(self.output, "rb") as f:
+            self.assertEqual(f.read(), DATA)
+        self.assertTrue(os.path.exists(self.file.torrent_path))
+
+    def test_sink_only(self):
+        """With sink storage, pieces are held until written out, after which they are no longer uploaded."""
+        self.file = torrentula.File("sink", self.destination, LENGTH, PIECE_LENGTH, HASHES, disk_workers=0, storage_mode="sink")
+        self.sink = torrentula.OrderedSink(self.file, self.output, buffer=PIECE_LENGTH)
+        self.add_piece(1)
+        self.assertTrue(self.sink.backlogged())
+        self.assertEqual(self.sink.window(), {0})
+        self.add_piece(0)
+        self.sink.finish()
+        with open(self.output, "rb") as f:
+            self.assertEqual(f.read(), DATA[: 2 * PIECE_LENGTH])
+        self.assertEqual(self.file.storage.held_bytes, 0)
+        self.assertEqual(self.file.get_data_from_piece(0, 100, 1), 0)
+        self.assertFalse(os.path.exists(self.file.torrent_path))
+        self.assertFalse(os.path.exists(self.file.bitfield_path))
+
+    def test_stdout_kept_clean(self):
+        """With the sink on stdout, reports printed while the torrent is loaded do not end up in the piped data."""
+        torrent = os.path.join(self.destination, "sink.torrent")
+        info = {b"name": b"sink", b"length": LENGTH, b"piece length": PIECE_LENGTH, b"pieces": b"".join(HASHES)}
+        with open(torrent, "wb") as f:
+            f.write(bencoder.bencode({b"announce": b"http://127.0.0.1:1/announce", b"info": info}))
+        saved_fd, saved_stdout = os.dup(1), sys.stdout
+        try:
+            with open(self.output, "wb") as captured:
+                os.dup2(captured.fileno(), 1)
+            sys.stdout = open(1, "w", closefd=False)
+            client = torrentula.Client(torrent, self.destination, recheck="full", sink="-")
+            self.file = client.file
+            client.sink.stop()
+            client.tracker.sock.close()
+        finally:
+            sys.stdout = saved_stdout
+            os.dup2(saved_fd, 1)
+            os.close(saved_fd)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.assertEqual(os.path.getsize(self.output), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
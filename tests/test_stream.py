@@ -0,0 +1,76 @@
+import unittest
+import os
+import shutil
+import hashlib
+import threading
+import time
+from urllib.request import Request, urlopen
+from tests import torrentula
+
+PIECE_LENGTH = 16 * 1024
+LENGTH = PIECE_LENGTH * 3 + 1000
+DATA = bytes(i % 251 for i in range(LENGTH))
+HASHES = [hashlib.sha1(DATA[i : i + PIECE_LENGTH]).digest() for i in range(0, LENGTH, PIECE_LENGTH)]
+
+
+class StreamTests(unittest.TestCase):
+    """
+    Usage: python -m unittest discover
+    Will run any tests matching the pattern 'test*.py'
+    """
+
+    def setUp(self):
+        self.destination = "test_stream_destination"
+        os.makedirs(self.destination, exist_ok=True)
+        self.file = torrentula.File("stream", self.destination, LENGTH, PIECE_LENGTH, HASHES, disk_workers=0)
+        self.stream = torrentula.StreamServer(self.file, 0)
+        self.url = f"http://{torrentula.LOOPBACK_IP}:{self.stream.server.server_address[1]}/"
+
+    def tearDown(self):
+        self.stream.shutdown()
+        self.file.close_file()
+        shutil.rmtree(self.destination)
+
+    def add_piece(self, index):
+        start = index * PIECE_LENGTH
+        self.file.pieces[index].add_block(0, DATA[start : start + self.file.pieces[index].length])
+        self.file.update_bitfield()
+        self.stream.notify()
+
+    def test_range_request_waits_for_pieces(self):
+        """A range request is answered once the pieces it covers are downloaded, and moves the playhead."""
+        self.add_piece(1)
+        threading.Timer(0.2, self.add_piece, (2,)).start()
+        request = Request(self.url, headers={"Range": f"bytes={PIECE_LENGTH + 10}-{2 * PIECE_LENGTH + 99}"})
+        with urlopen(request, timeout=10) as response:
+            self.assertEqual(response.status, 206)
+            self.assertEqual(response.headers["Content-Range"], f"bytes {PIECE_LENGTH + 10}-{2 * PIECE_LENGTH + 99}/{LENGTH}")
+            self.assertEqual(response.read(), DATA[PIECE_LENGTH + 10 : 2 * PIECE_LENGTH + 100])
+        self.assertEqual(self.stream.playhead.state[0], PIECE_LENGTH + 10)
+
+    def test_idle_time(self):
+        """The server is idle while no request is being answered, counting from the end of the last one."""
+        self.add_piece(0)
+        self.stream.last_active -= 5
+        self.assertGreaterEqual(self.stream.idle_for(), 5)
+        request = Request(self.url, headers={"Range": "bytes=0-99"})
+        with urlopen(request, timeout=10) as response:
+            self.assertEqual(response.read(), DATA[:100])
+        deadline = time.monotonic() + 5
+        while self.stream.active and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertLess(self.stream.idle_for(), 5)
+
+    def test_playhead_deadlines(self):
+        """Pieces within the read-ahead window are due in order of their distance from the reader."""
+        playhead = torrentula.Playhead(PIECE_LENGTH, LENGTH, window=2 * PIECE_LENGTH, rate=PIECE_LENGTH)
+        self.assertEqual(playhead.deadlines(), [])
+        playhead.seek(PIECE_LENGTH + 1)
+        deadlines = playhead.deadlines()
+        self.assertEqual([index for index, _ in deadlines], [1, 2, 3])
+        self.assertLessEqual(deadlines[0][1], time.monotonic())
+        self.assertGreater(deadlines[2][1], deadlines[1][1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,10 +2,21 @@
 from .core.client import Client
 
 # For testing
-from .core.block import Block
 from .core.file import File
 from .core.peer import Peer
 from .core.piece import Piece
+from .core.buffers import BufferPool
+from .core.cache import PieceCache
+from .core.hints import PageCacheHints
+from .core.scrub import Scrubber
+from .core.importer import ContentImporter
+from .core.transfer import StorageRegion, SendQueue
+from .core.stream import StreamServer, Playhead
+from .core.sink import OrderedSink
+from .core.layout import Layout
+from .core.storage import Storage, FileStorage, MmapStorage, MultiFileStorage, MemoryStorage, NullStorage, SinkStorage
+from .core.diskio import DiskWriter
+from .core.verifier import PieceVerifier
 from .core.strategy import *
 from .core.tracker import Tracker
 from .utils.helpers import *
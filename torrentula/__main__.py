@@ -1,6 +1,6 @@
 from .utils.helpers import configure_logging, parse_arguments, validate_arguments
 from .core.client import Client
-from .core.strategy import Strategy, RarestFirstStrategy, PropShareStrategy, RandomStrategy
+from .core.strategy import Strategy, RarestFirstStrategy, PropShareStrategy, RandomStrategy, StreamingStrategy
 
 
 def main():
@@ -8,7 +8,9 @@ def main():
     validate_arguments(args.torr, args.dest)
     configure_logging(args)
     # Initialize client object which unpacks the torrent file.
-    if args.rarest:
+    if args.stream:  # Picks the pieces ahead of stream readers first, and the rest rarest first.
+        strategy = StreamingStrategy
+    elif args.rarest:
         strategy = RarestFirstStrategy
     elif args.propshare:
         strategy = PropShareStrategy
@@ -27,7 +29,22 @@ def main():
         "endgame_threshold": args.endgame,
         "loopback_ports": args.loopback,
         "internal": args.internal,
-        "pref": args.pref
+        "pref": args.pref,
+        "storage": args.storage,
+        "prealloc": args.prealloc,
+        "disk_workers": args.disk_workers,
+        "hash_workers": args.hash_workers,
+        "hash_pool": args.hash_pool,
+        "recheck": args.recheck,
+        "memory_budget": args.memory_budget,
+        "read_cache": args.read_cache,
+        "page_cache": args.page_cache,
+        "scrub_rate": args.scrub_rate,
+        "stream": args.stream,
+        "sink": args.sink,
+        "sink_only": args.sink_only,
+        "import_from": args.import_from,
+        "priorities": args.priority,
     }
     client = Client(**kwargs)
 
@@ -39,6 +56,8 @@ def main():
 
     if args.seed:
         client.seed_torrent()
+    else:
+        client.finish_stream()
 
 
 if __name__ == "__main__":
@@ -6,6 +6,8 @@ VERSION = "1.0.0"
 LOG_FILENAME = f"{APP_NAME.lower()}.log"
 LOG_DIRECTORY = "logs"
 PEER_INACTIVITY_TIMEOUT_SECS = 120
+MAX_CORRUPT_PIECES = 3  # Pieces a peer may send corrupt data for before it is disconnected and banned for the session.
+SEND_TIMEOUT_SECS = 5  # Time a peer's socket may accept none of the data queued for it before the peer is disconnected.
 EPOCH_DURATION_SECS = 10  # From BEP3, the official BitTorrent v1 specification
 PEER_ID_LENGTH = 20
 HTTP_PORT = 0
@@ -14,6 +16,40 @@ IN_PROGRESS_FILENAME_SUFFIX = ".part"
 BITFIELD_FILE_SUFFIX = ".bitfield"
 MAX_CONNECTION_ATTEMPTS = 10
 LOOPBACK_IP = "127.0.0.1"
+STORAGE_MODES = ("file", "mmap", "memory", "null")
+VOLATILE_STORAGE_MODES = ("memory", "null", "sink")  # Storage that keeps nothing on disk. "sink" is selected by --sink-only.
+DEFAULT_STORAGE_MODE = "file"
+PREALLOCATION_MODES = ("sparse", "full", "legacy")
+DEFAULT_PREALLOCATION_MODE = "sparse"
+PREALLOCATION_CHUNK_BYTES = 2**20  # Bounds memory used when zero-filling in legacy mode.
+MAX_OPEN_FILES = 128  # Open file descriptors kept by multi-file storage.
+DISK_WRITE_WORKERS = 2  # Threads writing verified pieces to disk (0 writes synchronously).
+MAX_PENDING_DISK_WRITES = 32  # Pieces queued for writing before the client stops requesting blocks.
+MAX_COALESCED_WRITE_BYTES = 2**23  # Largest run of adjacent pieces stored by a single vectored write.
+MAX_POOLED_BUFFERS = 16  # Piece buffers kept for reuse once their pieces have been written.
+MEMORY_BUDGET_MB = 256  # Piece buffers held in memory before no new pieces are started.
+READ_CACHE_MB = 64  # Verified pieces kept in memory to serve uploads.
+PAGE_CACHE_MB = 256  # Data served to peers left in the OS page cache before it is dropped with posix_fadvise.
+STREAM_READAHEAD_BYTES = 32 * 2**20  # Data ahead of a streaming reader that is downloaded by deadline.
+STREAM_RATE_BYTES = 4 * 2**20  # Assumed read rate of a streaming reader (per second), from which piece deadlines are derived.
+STREAM_DUPLICATE_PEERS = 2  # Fastest peers that all request the blocks of an overdue streaming piece.
+STREAM_WAIT_SECS = 60  # Maximum time a stream request waits for the pieces it needs.
+STREAM_LINGER_SECS = 10  # Time a finished download is still streamed after the last stream request ended.
+STREAM_CHUNK_BYTES = 2**18  # Data sent per write to a stream request.
+SINK_BUFFER_MB = 64  # Completed pieces held for an ordered sink before only the pieces it needs next are started (and the most queued for writing to it).
+PRIORITY_LEVELS = ("skip", "low", "normal", "high")  # Download priorities of byte ranges, lowest first. Skipped pieces are never requested.
+DEFAULT_PRIORITY = "normal"
+HASH_WORKERS = 2  # Threads or processes verifying completed pieces (0 hashes on the event loop).
+HASH_POOL_TYPES = ("thread", "process")
+DEFAULT_HASH_POOL = "thread"
+RECHECK_MODES = ("full", "quick")
+RECHECK_READ_BYTES = 2**24  # Size of the sequential reads used when rechecking data on disk or importing it from other files.
+RECHECK_SAMPLE_PIECES = 64  # Pieces hashed by a quick recheck.
+SCRUB_RATE_MB = 8  # Rate (MB/s) at which pieces being seeded are verified again in the background (0 disables the scrubber).
+SCRUB_YIELD_SECS = 0.05  # Pause of the scrubber after a piece whenever uploads were served meanwhile.
+SCRUB_IDLE_SECS = 1  # Pause of the scrubber after a pass that found no piece to verify.
+RESUME_FLUSH_PIECES = 64  # Completed pieces that force the data to be synced and the resume file to be written.
+RESUME_FLUSH_INTERVAL_SECS = 5  # Maximum time that newly completed pieces go unsaved in the resume file.
 
 # Primary performance tuning parameters
 ENDGAME_THRESHOLD = 95
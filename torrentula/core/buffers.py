@@ -0,0 +1,47 @@
+from ..config import MAX_POOLED_BUFFERS, MEMORY_BUDGET_MB
+
+
+class BufferPool:
+    """
+    Recycles the buffers that pieces assemble their blocks into, so that a new piece does not allocate a fresh buffer.
+    Only buffers of the default piece length are pooled; the smaller last piece gets its own buffer.
+    Buffers are acquired and released on the event loop thread, after any worker using them has finished.
+    Also accounts for the bytes held by pieces in flight (from their first block until they are stored), which the client keeps within budget bytes.
+    """
+
+    def __init__(self, piece_length, max_buffers=MAX_POOLED_BUFFERS, budget=MEMORY_BUDGET_MB * 1_048_576):
+        self.piece_length = piece_length
+        self.max_buffers = max_buffers
+        self.free = []  # Buffers available for reuse.
+        self.budget = budget
+        self.in_flight = 0  # Bytes of the buffers currently held by pieces.
+
+    def acquire(self, length) -> bytearray:
+        """
+        Returns a buffer of the given length. Its contents are left over from previous use.
+        """
+        self.in_flight += length
+        if length == self.piece_length and self.free:
+            return self.free.pop()
+        return bytearray(length)
+
+    def release(self, buffer, reuse=True):
+        """
+        Returns a buffer once its piece no longer needs it. reuse is False if a worker may still be reading the buffer.
+        """
+        self.in_flight -= len(buffer)
+        if reuse and len(buffer) == self.piece_length and len(self.free) < self.max_buffers:
+            self.free.append(buffer)
+
+    def recycle(self, buffer):
+        """
+        Takes back a buffer that was released without reuse and kept elsewhere (see PieceCache) once it is no longer used.
+        """
+        if len(buffer) == self.piece_length and len(self.free) < self.max_buffers:
+            self.free.append(buffer)
+
+    def exhausted(self) -> bool:
+        """
+        Returns True if pieces in flight have used up the memory budget, in which case no new pieces should be started.
+        """
+        return self.in_flight >= self.budget
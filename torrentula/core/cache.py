@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from ..config import READ_CACHE_MB
+
+
+class PieceCache:
+    """
+    Least recently used cache of whole verified pieces, serving uploads from memory instead of reading each block from disk.
+    Peers request the blocks of a piece one after another, so the first request reads the whole piece ahead.
+    Pieces are evicted once the cached data exceeds budget bytes (a budget of 0 disables the cache).
+    Evicted piece buffers are handed back to pool (a BufferPool), so that pieces cached right after download do not keep the pool empty.
+    """
+
+    def __init__(self, budget=READ_CACHE_MB * 1_048_576, pool=None):
+        self.budget = budget
+        self.pool = pool
+        self.pieces = OrderedDict()  # Piece index to data, least recently used first.
+        self.size = 0  # Bytes of cached data.
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, index):
+        """
+        Returns the data of piece index, or None if it is not cached.
+        """
+        data = self.pieces.get(index)
+        if data is None:
+            self.misses += 1
+            return None
+        self.pieces.move_to_end(index)
+        self.hits += 1
+        return data
+
+    def insert(self, index, data) -> bool:
+        """
+        Caches the data of piece index, evicting the least recently used pieces to stay within budget. Returns False if it does not fit.
+        """
+        if len(data) > self.budget:
+            return False
+        self.discard(index)
+        self.pieces[index] = data
+        self.size += len(data)
+        while self.size > self.budget:
+            _, evicted = self.pieces.popitem(last=False)
+            self.size -= len(evicted)
+            self._recycle(evicted)
+        return True
+
+    def discard(self, index):
+        data = self.pieces.pop(index, None)
+        if data is not None:
+            self.size -= len(data)
+            self._recycle(data)
+
+    def clear(self):
+        for data in self.pieces.values():
+            self._recycle(data)
+        self.pieces.clear()
+        self.size = 0
+
+    def _recycle(self, data):
+        if self.pool is not None and isinstance(data, bytearray):  # Data read from storage is not a piece buffer.
+            self.pool.recycle(data)
@@ -7,10 +7,24 @@ from ..config import (
     BITTORRENT_PORT,
     MAX_CONNECTION_ATTEMPTS,
     LOOPBACK_IP,
+    DEFAULT_STORAGE_MODE,
+    DEFAULT_PREALLOCATION_MODE,
+    DISK_WRITE_WORKERS,
+    HASH_WORKERS,
+    DEFAULT_HASH_POOL,
+    MEMORY_BUDGET_MB,
+    READ_CACHE_MB,
+    PAGE_CACHE_MB,
+    SCRUB_RATE_MB,
+    STREAM_LINGER_SECS,
+    MAX_CORRUPT_PIECES,
 )
 from .tracker import Tracker
-from .strategy import Strategy
+from .strategy import Strategy, StreamingStrategy
+from .stream import StreamServer
+from .sink import OrderedSink, open_output
 from .file import File
+from .layout import decode_path
 from .piece import Piece
 from .tui import Tui
 import bencoder
@@ -48,21 +62,55 @@ class Client:
         endgame_threshold: int = 101,
         loopback_ports=[],  # For testing
         internal=False, # For testing
-        pref:str ="http"
+        pref:str ="http",
+        storage: str = DEFAULT_STORAGE_MODE,
+        prealloc: str = DEFAULT_PREALLOCATION_MODE,
+        disk_workers: int = DISK_WRITE_WORKERS,
+        hash_workers: int = HASH_WORKERS,
+        hash_pool: str = DEFAULT_HASH_POOL,
+        recheck: str = None,
+        memory_budget: int = MEMORY_BUDGET_MB,
+        read_cache: int = READ_CACHE_MB,
+        page_cache: int = PAGE_CACHE_MB,
+        scrub_rate: int = SCRUB_RATE_MB,
+        stream: int = None,
+        sink: str = None,
+        sink_only: bool = False,
+        import_from=[],
+        priorities=[],
     ):
         self.start_time = time.monotonic()
         self.bytes_uploaded: int = 0  # Total amount uploaded since client sent 'started' event to tracker
         self.bytes_downloaded: int = 0  # Total amount downloaded since client sent 'started' event to tracker
         self.download_speed = 0  # Measured per epoch in KB/s
         self.upload_speed = 0  # Measured per epoch in KB/s
+        self.bytes_wasted = 0  # Payload of duplicate or unneeded blocks received from peers, see Peer.bytes_wasted
         self.peers = []  # Connected clients within same swarm
+        self.banned = set()  # IP addresses and peer ids of peers that sent too much corrupt data, refused for the rest of the session
         self.port = port
         self.peer_id = Client.generate_id()
         self.destination = destination
         self.nat = nat
         self.tracker_pref = pref
+        self.storage_mode = "sink" if sink and sink_only else storage  # Pieces piped to the sink are only held until written out.
+        self.preallocation_mode = prealloc
+        self.disk_workers = disk_workers
+        self.hash_workers = hash_workers
+        self.hash_pool = hash_pool
+        self.recheck = recheck
+        self.memory_budget = memory_budget
+        self.read_cache = read_cache
+        self.page_cache = page_cache
+        self.scrub_rate = scrub_rate  # MB/s at which seeded pieces are verified again, 0 disables the scrubber.
+        self.stream_port = stream  # Port of the local HTTP server streaming the download, None to not stream.
+        self.stream = None
+        self.import_from = import_from  # Files and directories searched for pieces of the torrent before downloading.
+        sink_fd = open_output(sink) if sink else None  # Before loading the torrent, whose reports must not end up in data piped to stdout.
         self.load_torrent_file(torrent_file, clean, endgame_threshold)
         self.strategy = strategy()
+        for level, start, end in priorities:  # (level, first byte, end byte or None for the end of the torrent)
+            self.set_priority(start, self.length if end is None else end, level)
+        self.sink = OrderedSink(self.file, sink, fd=sink_fd) if sink else None  # Writes the data in order to stdout ("-") or a named pipe as it completes.
         self.loopback_ports = loopback_ports
         self.internal = internal
         # Register signal handlers
@@ -96,14 +144,42 @@ class Client:
         self.tracker = Tracker(self.announce_url, self.peer_id, self.info_hash, len(hashes), self.nat)
         # Extracts file metadata from torrent file and sets up the File class.
         self.filename: str = torrent_data[b"info"][b"name"].decode("utf-8")
-        self.length = int(torrent_data[b"info"][b"length"])
+        files = None
+        if b"files" in torrent_data[b"info"]:  # Multi-file torrent: the name is the directory holding every file.
+            try:
+                files = [(decode_path(entry[b"path"]), int(entry[b"length"])) for entry in torrent_data[b"info"][b"files"]]
+            except ValueError as e:
+                print(f"Error: {e}")
+                sys.exit(1)
+            self.length = sum(length for _, length in files)
+        else:
+            self.length = int(torrent_data[b"info"][b"length"])
         piece_length = int(torrent_data[b"info"][b"piece length"])
         # Verify integrity of torrent file size, hashes, and pieces.
         last_piece_size = self.length - (piece_length * (len(hashes) - 1))  # Last piece can be smaller.
         assert last_piece_size <= piece_length, "Error: Last piece is larger than piece size."
         calc_size_total = ((len(hashes) - 1) * piece_length) + last_piece_size
         assert calc_size_total == self.length, "Error: Torrent length, piece length and hashes do not match!"
-        self.file = File(self.filename, self.destination, self.length, piece_length, hashes, clean)
+        self.file = File(
+            self.filename,
+            self.destination,
+            self.length,
+            piece_length,
+            hashes,
+            clean,
+            storage_mode=self.storage_mode,
+            preallocation_mode=self.preallocation_mode,
+            files=files,
+            disk_workers=self.disk_workers,
+            hash_workers=self.hash_workers,
+            hash_pool=self.hash_pool,
+            recheck=self.recheck,
+            info_hash=self.info_hash,
+            memory_budget=self.memory_budget,
+            read_cache=self.read_cache,
+            page_cache=self.page_cache,
+            import_from=self.import_from,
+        )
         # Initialize variables for upload/download tracking statistics.
         # self.last_bytes_downloaded = self.file.bytes_downloaded()
         # self.last_bytes_uploaded = self.file.bytes_uploaded()
@@ -140,6 +216,8 @@ class Client:
         bool: True if the torrent download was successful, False if an error occurred.
         """
         self.open_socket()
+        if self.stream_port:
+            self.start_stream()
         self.peers = self.tracker.join_swarm(self.file.bytes_left(), self.port)
         self.epoch_start_time = datetime.now()
         self.repaint_progress()
@@ -167,7 +245,12 @@ class Client:
             self.receive_messages()
             self.cleanup_peers()
             completed_pieces = self.file.update_bitfield()
+            self.ban_corrupt_peers()
+            if self.sink:
+                self.sink.advance()
             if completed_pieces:
+                if self.stream:
+                    self.stream.notify()
                 if not self.tui.active:
                     self.repaint_progress()
                 self.send_uninterested()
@@ -178,25 +261,46 @@ class Client:
             self.send_interested()
             if datetime.now() - self.epoch_start_time >= timedelta(seconds=EPOCH_DURATION_SECS):
                 self.establish_new_epoch()
+        if self.sink:
+            self.sink.finish()
         # Clean up resources
         self.cleanup()
 
-        if self.file.complete():  # If file is complete, rename file to real name and delete bitfield.
+        if self.file.has_all_pieces():  # If file is complete, rename file to real name and delete bitfield.
             path = Path(self.destination)
             self.file.rename(path / self.filename)
             self.file.remove_bitfield_from_disk()
             print("\nTorrent download complete!")
             return True
+        if self.file.complete():  # Only skipped pieces are missing, keep the partial download and its progress.
+            self.file.write_bitfield_to_disk()
+            print("\nDownload of wanted data complete!")
+            return True
         return False
 
+    def set_priority(self, start, end, level):
+        """
+        Sets the download priority (one of PRIORITY_LEVELS) of bytes start up to end (exclusive) of the torrent. Can be called while downloading:
+        peers working on pieces that are no longer wanted cancel their outstanding requests and are given other pieces, and peers that have
+        nothing else we want are told that we are no longer interested.
+        """
+        self.file.set_priority(start, end, level)
+        wanted = self.file.missing_pieces()
+        for peer in self.connected_peers():
+            if peer.target_piece is not None and peer.target_piece not in wanted:
+                self.strategy.reassign(peer, None)
+        self.send_uninterested()
+
     def seed_torrent(self):
         """
         Seed the given torrent file. This method should run without download_torrent as a prerequisite. However, it assumes the seeder has a valid file.
+        A download that finished with skipped pieces only seeds the pieces it has (see File.seed_file()).
         """
         self.open_socket()
         self.file.seed_file()
+        self.file.start_scrubber(self.scrub_rate)
         self.tracker = Tracker(self.announce_url, self.peer_id, self.info_hash, len(self.file.bitfield), self.nat)
-        self.peers = self.tracker.join_swarm(0, self.port)
+        self.peers = self.tracker.join_swarm(self.file.bytes_left(), self.port)
         self.peers = []  # No need to retain knowledge of peers in swarm.
         if self.tui.active:
             self.tui.win.clear()
@@ -209,11 +313,48 @@ class Client:
             self.receive_messages()
             self.send_requests_reponses_back()
             self.send_keepalives()
+            if self.file.collect_scrub() and not self.tui.active:
+                print("\nCorrupt pieces found on disk are no longer uploaded. Download the torrent again to repair them.")
             if datetime.now() - self.epoch_start_time >= timedelta(seconds=EPOCH_DURATION_SECS):
                 self.cleanup_peers()
                 self.cleanup_leechers()
                 self.establish_new_epoch()
 
+    def start_stream(self):
+        """
+        Serves the download over HTTP as it progresses, downloading the pieces ahead of readers first if the streaming strategy is used.
+        """
+        try:
+            self.stream = StreamServer(self.file, self.stream_port)
+        except OSError as e:
+            print(f"Error: Could not start stream server on port {self.stream_port}: {e}")
+            return
+        if isinstance(self.strategy, StreamingStrategy):
+            self.strategy.playhead = self.stream.playhead
+        print(f"Streaming download at http://{LOOPBACK_IP}:{self.stream_port}/")
+
+    def finish_stream(self):
+        """
+        Keeps streaming the finished download until no stream request has been answered for STREAM_LINGER_SECS, or the client is interrupted,
+        then shuts the stream server down. Called instead of seed_torrent(), which keeps streaming while seeding.
+        """
+        if not self.stream:
+            return
+        if not self.file.volatile:  # Volatile storage lost its data when it was closed.
+            self.file.open_for_reading()
+            self.streaming = True
+            signal.signal(signal.SIGINT, self.stop_streaming)
+            signal.signal(signal.SIGTERM, self.stop_streaming)
+            print("Streaming the download until its readers are done, press Ctrl+C to stop.")
+            while self.streaming and self.stream.idle_for() < STREAM_LINGER_SECS:
+                time.sleep(0.2)
+        self.stream.shutdown()
+        self.stream = None
+        self.file.close_file()
+
+    def stop_streaming(self, signum=None, frame=None):
+        self.streaming = False
+
     def cleanup_leechers(self):
         for peer in self.peers:
             if peer.get_state() == PeerState.DISCONNECTED and peer.timeout():
@@ -234,6 +375,8 @@ class Client:
     def establish_new_epoch(self):
         total_downloaded = 0
         total_uploaded = 0
+        wasted = sum(peer.bytes_wasted for peer in self.peers)
+        self.bytes_wasted += wasted
         for peer in self.peers:
             downloaded, uploaded = peer.establish_new_epoch()
             total_downloaded += downloaded
@@ -242,6 +385,19 @@ class Client:
         self.upload_speed = total_uploaded / 10_485_760
         self.execute_choke_transition()
         self.epoch_start_time = datetime.now()
+        if self.file.verifier:
+            verifier = self.file.verifier
+            logger.info(f"Hash queue depth: {verifier.queue_depth()}, pieces hashed: {verifier.pieces_hashed}, throughput: {verifier.throughput():.2f} MB/s per worker")
+        logger.info(f"Duplicate or unneeded blocks: {wasted / 1_048_576:.2f} MB this epoch, {self.bytes_wasted / 1_048_576:.2f} MB in total")
+        if self.file.writer:
+            logger.info(f"Disk writes pending: {self.file.writer.pending}, pieces merged into vectored writes: {self.file.writer.coalesced}")
+        cache = self.file.cache
+        logger.info(f"Read cache: {len(cache.pieces)} pieces ({cache.size / 1_048_576:.2f} MB), {cache.hits} hits, {cache.misses} misses")
+        scrubber = self.file.scrubber
+        if scrubber:
+            logger.info(f"Scrubber: pass {scrubber.passes + 1} {scrubber.progress():.2f}% done, {scrubber.pieces_checked} pieces checked, {len(self.file.corrupt)} corrupt, {scrubber.throughput():.2f} MB/s")
+        hints = self.file.hints
+        logger.info(f"Page cache: {len(hints.served)} served pieces ({hints.size / 1_048_576:.2f} MB) left cached, {hints.dropped} dropped")
         logger.debug("Established new epoch.")
 
     def execute_choke_transition(self):
@@ -260,6 +416,11 @@ class Client:
         connected_peers: int = len([peer for peer in self.peers if peer.tcp_established])
         while rdy and connected_peers < MAX_CONNECTED_PEERS:  # Accept up to the maximum number of peers
             sock, addr = self.sock.accept()
+            if addr[0] in self.banned:
+                sock.close()
+                logger.debug(f"Refused connection from banned peer: {addr}")
+                rdy, _, _ = select.select([self.sock], [], [], timeout)
+                continue
             new_peer = Peer(addr[0], addr[1], self.info_hash, self.peer_id, len(self.file.bitfield), sock)
             self.peers.append(new_peer)
             connected_peers += 1
@@ -312,27 +473,56 @@ class Client:
         Sends data to pieces who are unchoked and have requested data
         """
         for peer in self.peers:
-            if peer.am_choking == False:
+            peer.flush_sends()
+            if peer.am_choking == False and not peer.sending():
                 if len(peer.incoming_requests) > 0:
                     data = peer.incoming_requests[0]
                     dataToSend = self.file.get_data_from_piece(data[1], data[2], data[0])
-                    if dataToSend == 0:  # Issue getting data
+                    if dataToSend == 0:  # Issue getting data, or a piece we no longer upload
+                        peer.drop_request(data)  # Drop the request, it would otherwise block every request queued behind it.
                         continue
                     flag = peer.send_piece(data[0], data[1], dataToSend)
                     if flag == Status.SUCCESS:
                         self.file.total_uploaded += data[2]  # update total uploaded
                         logger.debug(f"Data send back to {peer.addr} successfully")
+                        if not self.requested_by_any_peer(data[0]):
+                            self.file.finished_serving(data[0])
                     else:  # failed
                         logger.debug(f"Data failed to send back to {peer.addr}")
 
+    def requested_by_any_peer(self, index) -> bool:
+        return any(peer.requested_pieces[index] for peer in self.peers)
+
     def send_keepalives(self):
         for peer in self.peers:
             peer.send_keepalive_if_needed()
 
     def send_requests(self):
+        if self.file.writes_backlogged():  # Let the disk catch up before buffering more pieces in memory.
+            logger.debug("Background write queue is full, not requesting blocks.")
+            return
         connected = self.connected_peers()
-        self.strategy.assign_pieces(self.file.missing_pieces(), connected)
+        # Finish partially downloaded pieces that no peer is working on before starting new ones.
+        abandoned = (self.file.in_progress_pieces() & self.file.missing_pieces()) - {peer.target_piece for peer in connected}
+        if abandoned:
+            self.strategy.assign_pieces(abandoned, connected)
+        # Only as many idle peers are given a new piece as there are pieces that fit in the memory budget.
+        room = self.file.startable_pieces({peer.target_piece for peer in connected if peer.target_piece is not None})
+        idle = [peer for peer in connected if peer.target_piece is None and not peer.peer_choking and peer.am_interested]
+        starting = [peer for peer in connected if peer not in idle] + idle[:room]
+        if not room:
+            logger.debug(f"Memory budget reached with {self.file.bytes_in_flight()} bytes in flight, not starting new pieces.")
+        elif self.sink and self.sink.backlogged():  # Only the pieces the sink needs next may add to the pieces it holds.
+            self.strategy.assign_pieces(self.sink.window() & self.file.missing_pieces(), starting)
+        else:
+            if self.sink:  # Idle peers take the pieces the sink needs next before any others.
+                self.strategy.assign_pieces(self.sink.window() & self.file.missing_pieces(), starting)
+            for tier in self.file.priority_tiers():  # Idle peers take the highest priority pieces they have.
+                self.strategy.assign_pieces(tier, starting)
+        for index in self.strategy.urgent_pieces():  # Request the blocks of urgent pieces from every peer assigned to them.
+            self.file.pieces[index].endgame_mode = True
         available_peers = [peer for peer in connected if not peer.peer_choking and peer.am_interested and peer.target_piece is not None]
+        available_peers.sort(key=lambda peer: peer.corrupt_pieces)  # Peers with a clean record claim pieces that failed their hash check first.
         for peer in available_peers:
             # Reset target_piece if completed already.
             target_piece_object: Piece = self.file.pieces[peer.target_piece]
@@ -341,13 +531,46 @@ class Client:
                 peer.target_piece = None
                 for tup in set(peer.outgoing_requests):
                     peer.send_cancel(tup[0], tup[1], tup[2])
+            elif target_piece_object.hash_failures and not self.claim_piece(target_piece_object, peer):
+                peer.target_piece = None  # The piece is downloaded again from a single peer, so a second failure can be blamed on it.
             else:
                 num_requests = MAX_PEER_OUTSTANDING_REQUESTS - len(peer.outgoing_requests)
-                for req in range(num_requests):
-                    offset, length = target_piece_object.get_next_request()
-                    if offset is None or length is None or peer.target_piece is None:  # Target piece has allocated all block requests.
+                for offset, length in target_piece_object.get_next_requests(num_requests):
+                    if peer.target_piece is None:  # Peer was dropped while sending.
                         break
-                    peer.send_request(peer.target_piece, offset, length)
+                    if peer.send_request(peer.target_piece, offset, length) == Status.SUCCESS:
+                        target_piece_object.add_holder(offset, peer)  # So the peer is sent a cancel if another copy arrives first.
+
+    def claim_piece(self, piece: Piece, peer) -> bool:
+        """
+        Makes peer the only peer a piece that failed its hash check is requested from, unless another peer still holds it. Returns True if peer holds it.
+        """
+        owner = piece.owner
+        if owner is None or not owner.tcp_established or owner.target_piece != piece.index:
+            piece.owner = peer
+        return piece.owner is peer
+
+    def ban_corrupt_peers(self):
+        """
+        Counts the corrupt pieces reported by File against the peers that sent them.
+        Peers that reach MAX_CORRUPT_PIECES are disconnected and banned, by address and peer id, for the rest of the session.
+        """
+        while self.file.blame:
+            index, peer = self.file.blame.popleft()
+            peer.corrupt_pieces += 1
+            logger.info(f"Peer at {peer.addr} sent corrupt data for piece {index} ({peer.corrupt_pieces} corrupt pieces)")
+            if peer.corrupt_pieces >= MAX_CORRUPT_PIECES:
+                self.banned.add(peer.addr[0])
+                if peer.remote_peer_id:
+                    self.banned.add(peer.remote_peer_id)
+        if not self.banned:
+            return
+        for peer in [peer for peer in self.peers if peer.addr[0] in self.banned or peer.remote_peer_id in self.banned]:
+            logger.info(f"Disconnecting banned peer at {peer.addr}.")
+            peer.disconnect()
+            self.peers.remove(peer)
+            if self.tui.active:
+                self.tui.win.clear()
 
     def send_interested(self):
         uninterested = [peer for peer in self.connected_peers() if not peer.am_interested]
@@ -380,6 +603,9 @@ class Client:
                 sockets_to_peers[socket].receive_messages(target_piece)
             else:
                 sockets_to_peers[socket].receive_messages(None)
+            for index in sockets_to_peers[socket].newly_requested:  # Read each requested piece ahead once, before it is served.
+                self.file.prefetch_piece(index)
+            sockets_to_peers[socket].newly_requested.clear()
             if sockets_to_peers[socket].can_send_bitfield:
                 bitfield_list = self.file.bitfield
                 bitfield = bytearray(math.ceil(len(self.file.bitfield) / 8))
@@ -440,6 +666,9 @@ class Client:
         output += f"Time: {minutes}:{seconds:02d} | "
         output += f"Peers: {len(self.peers)} ({len(self.connected_peers())} connected) | "
         output += f"Completed: {self.file.get_progress()} | "
+        output += f"In Flight: {self.file.bytes_in_flight() / 1_048_576:.2f} MB | "
+        if self.sink:
+            output += f"Piped: {self.sink.bytes_written / 1_048_576:.2f} MB | "
         output += f"Download Speed: {self.download_speed:.2f} MB/s | "
         output += f"Upload Speed: {self.upload_speed:.2f} MB/s | "
         output += f"Port: {self.port}" 
@@ -463,6 +692,8 @@ class Client:
         output += f"Peers: {len(self.peers)} ({len(self.connected_peers())} connected) | "
         output += f"Uploaded: {self.file.bytes_uploaded() / 1_048_576:.2f} MB | "
         output += f"Upload Speed: {self.upload_speed:.2f} MB/s"
+        if self.file.scrubber:
+            output += f" | Scrub: {self.file.scrubber.progress():.0f}% ({self.file.scrubber.throughput():.2f} MB/s)"
         return output
 
     def repaint_seeding(self):
@@ -491,7 +722,12 @@ class Client:
         """
         traceback.print_stack()
         print("Received SIGINT or SIGTERM. Cleaning up resource and shutting down...")
+        if self.stream:
+            self.stream.shutdown()
+        if self.sink:
+            self.sink.stop(discard=True)
         self.cleanup()
+        self.file.update_bitfield()  # Record pieces whose background writes finished during cleanup.
         self.file.write_bitfield_to_disk()
         sys.exit(1)
 
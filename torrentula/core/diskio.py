@@ -0,0 +1,91 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from queue import SimpleQueue, Empty
+from ..config import DISK_WRITE_WORKERS, MAX_PENDING_DISK_WRITES, MAX_COALESCED_WRITE_BYTES
+from ..utils.helpers import logger
+
+
+class DiskWriter:
+    """
+    Writes verified pieces to storage on a pool of worker threads, so that receiving from peers never waits on the disk.
+    Each worker takes the queued piece with the lowest offset together with any queued pieces directly after it, and stores them with one vectored write.
+    Workers never share a file position, so they write concurrently.
+    Completed writes are reported back through a queue that File drains once per event loop iteration.
+    The queue of pending writes is bounded: while it is full the client stops requesting new blocks.
+    """
+
+    def __init__(self, storage, workers=DISK_WRITE_WORKERS, max_pending=MAX_PENDING_DISK_WRITES, max_coalesced=MAX_COALESCED_WRITE_BYTES):
+        self.storage = storage
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="disk-writer")
+        self.max_pending = max_pending
+        self.max_coalesced = max_coalesced
+        self.lock = threading.Lock()  # Guards queued.
+        self.queued = []  # (offset, piece index, data) of writes not yet taken by a worker.
+        self.pending = 0  # Writes that have been submitted but not yet collected.
+        self.tasks = set()  # Futures of worker tasks, for wait().
+        self.completed = SimpleQueue()  # (piece index, exception or None) for each finished write.
+        self.coalesced = 0  # Writes merged into the write of the piece before them.
+
+    def submit(self, index, offset, data):
+        """
+        Queues data to be written at the given byte offset of the torrent on behalf of piece index.
+        """
+        with self.lock:
+            self.queued.append((offset, index, data))
+        self.pending += 1
+        self.tasks.add(self.executor.submit(self.write_queued))
+
+    def write_queued(self):
+        """
+        Runs on a worker: writes the next run of adjacent queued pieces, if another worker has not taken them already.
+        """
+        with self.lock:
+            if not self.queued:
+                return
+            self.queued.sort(key=lambda write: write[0])
+            end = self.queued[0][0] + len(self.queued[0][2])
+            count = 1
+            while count < len(self.queued) and self.queued[count][0] == end and end + len(self.queued[count][2]) - self.queued[0][0] <= self.max_coalesced:
+                end += len(self.queued[count][2])
+                count += 1
+            run = self.queued[:count]
+            del self.queued[:count]
+            self.coalesced += count - 1
+        error = None
+        try:
+            if count == 1:
+                self.storage.write(run[0][0], run[0][2])
+            else:
+                self.storage.writev(run[0][0], [data for _, _, data in run])
+        except Exception as e:
+            error = e
+        for _, index, _ in run:
+            self.completed.put((index, error))
+
+    def full(self) -> bool:
+        return self.pending >= self.max_pending
+
+    def collect(self) -> list[tuple[int, Exception]]:
+        """
+        Returns (piece index, exception or None) for every write that finished since the last call.
+        """
+        self.tasks = {task for task in self.tasks if not task.done()}
+        results = []
+        while True:
+            try:
+                index, error = self.completed.get_nowait()
+            except Empty:
+                return results
+            self.pending -= 1
+            if error:
+                logger.error(f"Background write of piece {index} failed: {error}")
+            results.append((index, error))
+
+    def wait(self):
+        """
+        Blocks until every submitted write has finished.
+        """
+        wait(list(self.tasks))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
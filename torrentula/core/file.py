@@ -1,20 +1,112 @@
 from .piece import Piece
+from .buffers import BufferPool
+from .cache import PieceCache
+from .hints import PageCacheHints
+from .scrub import Scrubber
+from .importer import ContentImporter
+from .transfer import StorageRegion
 from math import ceil
 from pathlib import Path
 import os
-from ..config import BITFIELD_FILE_SUFFIX, IN_PROGRESS_FILENAME_SUFFIX, ENDGAME_THRESHOLD
+import random
+import shutil
+import time
+import weakref
+from collections import deque
+from .layout import Layout
+from .resume import read_resume_file, write_resume_file, data_signature
+from .storage import open_storage, preallocate
+from .diskio import DiskWriter
+from .verifier import PieceVerifier
+from ..config import (
+    BITFIELD_FILE_SUFFIX,
+    IN_PROGRESS_FILENAME_SUFFIX,
+    ENDGAME_THRESHOLD,
+    DEFAULT_STORAGE_MODE,
+    VOLATILE_STORAGE_MODES,
+    DEFAULT_PREALLOCATION_MODE,
+    DISK_WRITE_WORKERS,
+    HASH_WORKERS,
+    DEFAULT_HASH_POOL,
+    RECHECK_READ_BYTES,
+    RECHECK_SAMPLE_PIECES,
+    RESUME_FLUSH_PIECES,
+    RESUME_FLUSH_INTERVAL_SECS,
+    MEMORY_BUDGET_MB,
+    READ_CACHE_MB,
+    PAGE_CACHE_MB,
+    PRIORITY_LEVELS,
+    DEFAULT_PRIORITY,
+)
 from ..utils.helpers import logger
 
 
 class File:
-    def __init__(self, name, destination, length, piece_length, hashes, clean=False, endgame_threshold=ENDGAME_THRESHOLD):
+    def __init__(
+        self,
+        name,
+        destination,
+        length,
+        piece_length,
+        hashes,
+        clean=False,
+        endgame_threshold=ENDGAME_THRESHOLD,
+        storage_mode=DEFAULT_STORAGE_MODE,
+        preallocation_mode=DEFAULT_PREALLOCATION_MODE,
+        files=None,
+        disk_workers=DISK_WRITE_WORKERS,
+        hash_workers=HASH_WORKERS,
+        hash_pool=DEFAULT_HASH_POOL,
+        recheck=None,
+        info_hash=bytes(20),
+        memory_budget=MEMORY_BUDGET_MB,
+        read_cache=READ_CACHE_MB,
+        page_cache=PAGE_CACHE_MB,
+        import_from=[],
+    ):
+        """
+        files lists the (relative path, length) of each file for multi-file torrents and is None for single-file torrents.
+        disk_workers is the number of threads writing verified pieces in the background (0 writes them synchronously).
+        hash_workers is the number of threads or processes (hash_pool) verifying completed pieces (0 hashes them synchronously).
+        recheck is "full" or "quick" to verify the data already on disk before downloading (see recheck()).
+        info_hash identifies the torrent in the resume file.
+        memory_budget is the number of MB that pieces in flight may hold in memory before no new pieces are started.
+        read_cache is the number of MB of verified pieces cached to serve uploads (unused with mmap storage, which is served from the page cache).
+        page_cache is the number of MB of data served to peers that is left in the OS page cache before it is dropped (see PageCacheHints).
+        import_from lists files and directories whose data is searched for missing pieces before downloading (see import_content()).
+        """
         self.piece_length = piece_length
+        self.buffers = BufferPool(piece_length, budget=memory_budget * 1_048_576)  # Reused buffers that pieces in progress assemble their blocks into.
+        self.storage_mode = storage_mode  # How piece data is stored (one of STORAGE_MODES, see open_storage()).
+        self.volatile = storage_mode in VOLATILE_STORAGE_MODES  # Nothing is kept on disk, not even the resume file.
+        self.cache = PieceCache(0 if storage_mode == "mmap" else read_cache * 1_048_576, self.buffers)
+        self.hints = PageCacheHints(page_cache * 1_048_576)
+        self.preallocation_mode = preallocation_mode  # How a new in-progress file is sized ("sparse", "full" or "legacy").
+        self.allocation_thread = None  # Background posix_fallocate in "full" mode.
+        self.storage = None
+        self.disk_workers = disk_workers
+        self.writer = None  # Set while downloading if pieces are written in the background.
+        self.hash_workers = hash_workers
+        self.hash_pool = hash_pool
+        self.verifier = None  # Set while downloading if pieces are hashed in the background.
+        self.scrubber = None  # Set while seeding if pieces are verified again in the background.
+        self.corrupt = set()  # Pieces the scrubber found corrupt, which are no longer uploaded.
+        self.uploads = weakref.WeakSet()  # StorageRegions handed out for upload, read into memory before their storage is closed.
+        self.released = set()  # Pieces an OrderedSink has written out and no longer holds (with "sink" storage), which can no longer be uploaded.
         self.name = name
         self.destination = destination
         self.hashes = hashes
+        self.priorities = [PRIORITY_LEVELS.index(DEFAULT_PRIORITY)] * len(hashes)  # Index into PRIORITY_LEVELS of each piece.
+        self.info_hash = info_hash
+        self.unsaved_pieces = 0  # Completed pieces not yet recorded in the resume file.
+        self.last_saved = time.monotonic()
+        self.stale = False  # Set if the resume file cannot be trusted.
+        self.journal = {}  # Piece index to one flag per block, for partially downloaded pieces whose received blocks are in storage.
         self.bitfield_path = Path(destination) / f"{name}{BITFIELD_FILE_SUFFIX}"
         self.torrent_path = Path(destination) / f"{name}{IN_PROGRESS_FILENAME_SUFFIX}"
         self.final_path = Path(self.destination) / self.name
+        # Multi-file torrents are downloaded into a directory, which is renamed as a whole like a single file.
+        self.layout = Layout.for_files(files, piece_length) if files else Layout.for_single_file(length, piece_length)
         if clean:
             self.remove_artifacts()
         self.length = length
@@ -22,101 +114,344 @@ class File:
         self.total_uploaded = 0  # In bytes
         self.initialize_pieces()
         self.bitfield: list[int] = self.load_bitfield_from_disk()
+        if not (recheck or self.stale):
+            self.restore_partial_pieces()
         self.initialize_missing_pieces()
+        if recheck or self.stale:
+            self.recheck(quick=recheck == "quick" and not self.stale)
+        if import_from and self.torrent_path != self.final_path:
+            self.import_content(import_from)
         self.endgame_mode = False
         self.endgame_threshold = endgame_threshold
 
     def initialize_pieces(self):
         logger.debug("Initializing pieces...")
-        self.pieces: list[Piece] = [Piece(index, self.piece_length, hash, self.length, self.torrent_path, self.file) for index, hash in enumerate(self.hashes)]
+        self.events = deque()  # Indices of pieces whose progress changed since the last update_bitfield().
+        self.blame = deque()  # (piece index, peer) for every peer found to have sent corrupt data, handled by the client.
+        self.pieces: list[Piece] = [
+            Piece(index, self.piece_length, hash, self.length, self.torrent_path, self.storage, self.writer, self.verifier, self.events, self.buffers, self.blame)
+            for index, hash in enumerate(self.hashes)
+        ]
         self.pieces[-1].length = self.length - (len(self.pieces) - 1) * self.piece_length
         logger.debug(f"File - last piece length {self.length - (len(self.pieces) - 1) * self.piece_length}")
 
     def seed_file(self):
         """
-        Open complete file for seeding and initialize bitfield to all ones.
+        Opens the downloaded data read-only for seeding. A complete file is seeded with every piece, so its bitfield is set to all ones.
+        A download that finished with skipped pieces keeps its in-progress name and is seeded with the pieces its bitfield records.
         """
-        self.file = open(self.torrent_path, "rb")
-        self.bitfield = [1] * len(self.hashes)
-        self.write_bitfield_to_disk()
+        if self.storage:
+            self.detach_uploads()
+            self.storage.close()
+        self.storage = open_storage(self.storage_mode, self.layout, self.torrent_path, readonly=True)
+        if self.torrent_path == self.final_path:
+            self.bitfield = [1] * len(self.hashes)
+            self.write_bitfield_to_disk()
         self.initialize_pieces()
 
+    def open_for_reading(self):
+        """
+        Opens the downloaded data read-only after close_file(), so that it can still be streamed once the download has finished.
+        """
+        if self.storage is None:
+            self.storage = open_storage(self.storage_mode, self.layout, self.torrent_path, readonly=True)
+
     def remove_artifacts(self):
         for path in [self.bitfield_path, self.torrent_path, self.final_path]:
-            if os.path.exists(path):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+                logger.info(f"Running with '--clean' argument: removed directory '{path}'")
+            elif os.path.exists(path):
                 os.remove(path)
                 logger.info(f"Running with '--clean' argument: removed file '{path}'")
 
     def initialize_file(self):
+        if self.volatile:
+            self.storage = open_storage(self.storage_mode, self.layout, self.torrent_path)
+            logger.debug(f"Keeping the download in {self.storage_mode} storage, nothing is written to disk.")
+            self.start_workers()
+            return
         if os.path.exists(self.final_path):  # Assume file already completely downloaded
             self.torrent_path = self.final_path
             self.seed_file()  # TODO May be repetitive but still work.
         elif os.path.exists(self.torrent_path):  # Open existing file without overwriting
-            self.file = open(self.torrent_path, "rb+")
+            self.storage = open_storage(self.storage_mode, self.layout, self.torrent_path)
             logger.debug("In-progress download file already exists.")
         else:  # Create a new empty file
-            self.file = open(self.torrent_path, "wb+")
-            self.file.write(b"\x00" * self.length)
-            logger.debug(f"Created empty in-progress download file with size {self.length}.")
+            self.allocation_thread = preallocate(self.layout, self.torrent_path, self.preallocation_mode)
+            self.storage = open_storage(self.storage_mode, self.layout, self.torrent_path)
+            logger.debug(f"Created empty in-progress download file with size {self.length} ({self.preallocation_mode} preallocation).")
+        if not os.path.exists(self.final_path):
+            self.start_workers()
+
+    def start_workers(self):
+        """
+        Starts the background pools that verify and write downloaded pieces.
+        """
+        if self.disk_workers > 0:
+            self.writer = DiskWriter(self.storage, self.disk_workers)
+        if self.hash_workers > 0:
+            self.verifier = PieceVerifier(self.hash_workers, self.hash_pool)
+
+    def recheck(self, quick=False):
+        """
+        Verifies the data already on disk against the piece hashes and rebuilds the bitfield from the result.
+        In quick mode only a sample of the pieces the bitfield claims to have is hashed. If all of them are valid the bitfield is trusted, otherwise every piece is rechecked.
+        A completed file with corrupt pieces is moved back to its in-progress name so that those pieces are downloaded again.
+        """
+        start = time.monotonic()
+        self.cache.clear()
+        self.journal = {}  # Partial pieces are downloaded again, only whole pieces are rechecked.
+        if quick:
+            have = self.has_pieces()
+            sample = sorted(random.sample(have, min(RECHECK_SAMPLE_PIECES, len(have))))
+            results = self.hash_pieces(sample)
+            if all(results.values()):
+                self.report_recheck(results, start, sampled=True)
+                return
+            logger.info("Quick recheck found corrupt pieces, rechecking every piece.")
+        results = self.hash_pieces(range(len(self.pieces)))
+        if not all(results.values()) and self.torrent_path == self.final_path:
+            self.reopen_for_download()
+        for index, valid in results.items():
+            if valid:
+                self.pieces[index].set_complete_from_prev_download()
+            else:
+                self.pieces[index].reset()
+            self.bitfield[index] = int(valid)
+        self.initialize_missing_pieces()
+        self.write_bitfield_to_disk()
+        self.report_recheck(results, start)
+
+    def hash_pieces(self, indices) -> dict[int, bool]:
+        """
+        Reads the given pieces from storage with sequential reads of about RECHECK_READ_BYTES and hashes them on every core.
+        Returns whether each piece matched its hash.
+        """
+        workers = os.cpu_count() or 1
+        verifier = PieceVerifier(workers, "thread")  # Threads can hash slices of a read without copying them.
+        results = {}
+        batch = []  # Consecutive piece indices covered by a single read.
+        self.advise(0, self.length, "sequential")  # Larger read-ahead for the sequential reads below.
+
+        def read_batch():
+            offset = batch[0] * self.piece_length
+            length = sum(self.pieces[index].length for index in batch)
+            data = memoryview(self.storage.read(offset, length))
+            self.advise(offset, length, "dontneed")  # Drop behind, rechecking a large torrent should not evict everything else from the page cache.
+            for index in batch:
+                start = index * self.piece_length - offset
+                verifier.submit(index, data[start : start + self.pieces[index].length])
+            batch.clear()
+            if verifier.queue_depth() >= 2 * workers:  # Bound the data held in memory.
+                verifier.wait()
+                results.update(verifier.collect())
+
+        for index in indices:
+            if batch and (index != batch[-1] + 1 or len(batch) * self.piece_length >= RECHECK_READ_BYTES):
+                read_batch()
+            batch.append(index)
+        if batch:
+            read_batch()
+        verifier.wait()
+        results.update(verifier.collect())
+        verifier.shutdown()
+        self.advise(0, self.length, "normal")
+        self.hints.clear()
+        return {index: digest == self.hashes[index] for index, digest in results.items()}
+
+    def report_recheck(self, results, start, sampled=False):
+        elapsed = max(time.monotonic() - start, 1e-6)
+        checked = sum(self.pieces[index].length for index in results) / 1_000_000
+        valid = sum(results.values())
+        kind = "Quick recheck" if sampled else "Recheck"
+        message = f"{kind}: {valid} of {len(results)} pieces valid, {checked:.2f} MB in {elapsed:.2f}s ({checked / elapsed:.2f} MB/s)."
+        print(message)
+        logger.info(message)
+
+    def import_content(self, paths):
+        """
+        Copies the missing pieces found in the files at or below paths (see ContentImporter) into storage and records them as downloaded,
+        so that only the data that differs is fetched from peers.
+        """
+        start = time.monotonic()
+        importer = ContentImporter(self, os.cpu_count() or 1)
+        found = importer.run(paths)
+        for index in found:
+            self.pieces[index].reset()  # Blocks restored from the journal are superseded by the whole piece.
+            self.pieces[index].set_complete_from_prev_download()
+            self.bitfield[index] = 1
+        if found:
+            self.initialize_missing_pieces()
+            self.write_bitfield_to_disk()
+        elapsed = max(time.monotonic() - start, 1e-6)
+        scanned = importer.bytes_scanned / 1_000_000
+        imported = sum(self.pieces[index].length for index in found) / 1_000_000
+        message = f"Import: {len(found)} pieces ({imported:.2f} MB) found in {importer.files_scanned} files, {scanned:.2f} MB scanned in {elapsed:.2f}s ({scanned / elapsed:.2f} MB/s)."
+        print(message)
+        logger.info(message)
+
+    def start_scrubber(self, rate):
+        """
+        Starts verifying the pieces we have again in the background at rate MB/s (see Scrubber). A rate of 0 does nothing.
+        """
+        if rate > 0 and self.scrubber is None:
+            self.scrubber = Scrubber(self, rate * 1_048_576)
+
+    def collect_scrub(self) -> list[int]:
+        """
+        Marks the pieces the scrubber found corrupt as missing, so that they are no longer uploaded, and returns them.
+        A completed file is moved back to its in-progress name so that the next download fetches them again.
+        """
+        corrupt = self.scrubber.collect() if self.scrubber else []
+        if not corrupt:
+            return corrupt
+        for index in corrupt:
+            logger.error(f"Piece {index} failed verification by the scrubber and will be downloaded again.")
+            self.corrupt.add(index)
+            self.cache.discard(index)
+            self.bitfield[index] = 0
+        if self.torrent_path == self.final_path:
+            rate = self.scrubber.rate / 1_048_576
+            self.reopen_for_download()  # Stops the scrubber along with the storage.
+            self.start_scrubber(rate)
+        self.initialize_missing_pieces()
+        self.write_bitfield_to_disk()
+        return corrupt
+
+    def reopen_for_download(self):
+        """
+        Moves a completed file that failed verification back to its in-progress name and opens it for downloading.
+        """
+        self.close_file()
+        part_path = Path(self.destination) / f"{self.name}{IN_PROGRESS_FILENAME_SUFFIX}"
+        self.rename(part_path)
+        self.storage = open_storage(self.storage_mode, self.layout, self.torrent_path)
+        self.start_workers()
+        self.initialize_pieces()
 
     def get_bitfield(self):
         return self.bitfield
 
     def write_bitfield_to_disk(self):
         """
-        Writes bitfield to disk to save progress.
+        Atomically writes the bitfield to the resume file, along with the size and modification time of the downloaded data.
+        The data is synced to disk first, so that after a crash the resume file never records pieces whose writes were lost.
         """
+        if self.volatile:
+            return
         logger.debug("Attempting to write bitfield to disk")
         try:
-            with open(self.bitfield_path, "w") as file:
-                for bit in self.bitfield:
-                    file.write(str(bit))
+            if self.storage:
+                self.storage.flush()
+            signature = data_signature(self.layout.paths(self.torrent_path))
+            # Journal entries become useless once their piece completes, or suspect if it failed its hash check.
+            self.journal = {index: blocks for index, blocks in self.journal.items() if not self.bitfield[index] and not self.pieces[index].hash_failures}
+            write_resume_file(self.bitfield_path, self.info_hash, self.bitfield, signature, self.journal)
+            self.unsaved_pieces = 0
+            self.last_saved = time.monotonic()
         except OSError as e:
             print(f"Error writing bitfield to disk: {e}")
             logger.debug("Error writing bitfield to disk")
 
+    def save_progress(self):
+        """
+        Writes the resume file once RESUME_FLUSH_PIECES pieces have completed or RESUME_FLUSH_INTERVAL_SECS have passed since it was last written.
+        Pieces that complete close together are saved by a single sync and write. Any pieces not yet saved after a crash are recovered by a recheck.
+        """
+        if self.unsaved_pieces >= RESUME_FLUSH_PIECES or time.monotonic() - self.last_saved >= RESUME_FLUSH_INTERVAL_SECS:
+            self.write_bitfield_to_disk()
+
     def load_bitfield_from_disk(self):
         """
         Loads bitfield from disk (if it exists) to restart where previous download left off.
         Marks already completed pieces as complete.
+        If the downloaded data was modified after the bitfield was saved, the download is marked stale so that it is rechecked.
         """
         logger.debug("Attempting to load bitfield from disk")
+        if self.volatile:
+            return [0] * len(self.pieces)
         try:
             # Check if bitfield and partially downloaded file already exists.
-            if os.path.isfile(self.bitfield_path) and os.path.isfile(self.torrent_path):
-                with open(self.bitfield_path, "r+") as file1:
-                    bitfield = [int(char) for char in file1.read().strip()]
-                    # Use the stored bitfield data to mark the appropriate pieces as already completed.
-                    for index, bit in enumerate(bitfield):
-                        if bit == 1:
-                            self.pieces[index].set_complete_from_prev_download()
-                    logger.info(f"Successfully reloaded progress from bitfield on disk: {bitfield}")
-                    return bitfield
-            else:  # Bitfield does not exist
-                bitfield = [0] * len(self.pieces)
-                with open(self.bitfield_path, "w") as file1:
-                    file1.write("".join(map(str, bitfield)))
+            if os.path.isfile(self.bitfield_path) and os.path.exists(self.torrent_path):
+                bitfield, signature, self.journal = read_resume_file(self.bitfield_path, self.info_hash, len(self.pieces))
+                if signature and signature != data_signature(self.layout.paths(self.torrent_path)):
+                    logger.info("Downloaded data changed after progress was last saved, it will be rechecked.")
+                    self.stale = True
+                # Use the stored bitfield data to mark the appropriate pieces as already completed.
+                for index, bit in enumerate(bitfield):
+                    if bit == 1:
+                        self.pieces[index].set_complete_from_prev_download()
+                logger.info(f"Successfully reloaded progress from bitfield on disk: {sum(bitfield)} of {len(bitfield)} pieces")
                 return bitfield
+            else:  # Bitfield does not exist
+                self.bitfield = [0] * len(self.pieces)
+                self.write_bitfield_to_disk()
+                return self.bitfield
         except OSError as e:
             print(f"Error accessing bitfield file: {e}")
             logger.debug("Error accessing bitfield file")
         except ValueError as e:
             print(f"Error parsing bitfield data: {e}")
             logger.debug("Error parsing bitfield data")
+        self.stale = True  # Progress is unknown, so recover it from the data on disk.
+        return [0] * len(self.pieces)
+
+    def checkpoint_partial_pieces(self) -> int:
+        """
+        Writes the blocks received for pieces still in progress to storage and records them in the journal, so that the next session continues
+        those pieces instead of downloading them again. Called before storage is closed. Returns the number of pieces checkpointed.
+        """
+        checkpointed = 0
+        for piece in self.pieces:
+            ranges = piece.received_ranges()
+            if not ranges:
+                continue
+            for start, end in ranges:
+                self.storage.write(piece.index * self.piece_length + start, memoryview(piece.pieceBuffer)[start:end])
+            self.journal[piece.index] = bytes(piece.received)
+            checkpointed += 1
+        return checkpointed
+
+    def restore_partial_pieces(self):
+        """
+        Rebuilds the pieces recorded in the journal from the blocks in storage.
+        """
+        for index, blocks in self.journal.items():
+            if not self.bitfield[index]:
+                self.pieces[index].restore_blocks(blocks)
+        restored = sum(self.pieces[index].downloaded for index in self.journal if not self.bitfield[index])
+        if restored:
+            logger.info(f"Restored {restored} bytes of {len(self.journal)} partially downloaded pieces.")
 
     def update_bitfield(self):
         """
-        Scans through progress on pieces to update bitfield in memory and writes it to disk to save any progress. Returns a list of indices representing newly completed pieces.
+        Updates the bitfield and progress counters from the pieces that reported a change since the last call, and saves any progress to the resume file (see save_progress()).
+        Returns a list of indices representing newly completed pieces.
         """
+        self.collect_verifications()
+        self.collect_writes()
         newly_completed = []
-        for index, bit in enumerate(self.bitfield):
-            if bit == 0 and self.pieces[index].complete:
+        while self.events:
+            index = self.events.popleft()
+            piece = self.pieces[index]
+            self.unverified_bytes += piece.downloaded - self.counted_bytes[index]
+            self.counted_bytes[index] = piece.downloaded
+            if piece.downloaded and not piece.complete:
+                self.in_progress.add(index)
+            else:
+                self.in_progress.discard(index)
+            # Only pieces whose data has been verified and has reached storage count as downloaded.
+            if self.bitfield[index] == 0 and piece.stored():
                 self.missing_pieces_set.remove(index)
+                self.tiers[self.priorities[index]].discard(index)
+                self.wanted_pieces.discard(index)
                 newly_completed.append(index)
                 self.bitfield[index] = 1
+                self.verified_bytes += piece.length
 
         if newly_completed:  # Bitfield was updated
-            self.write_bitfield_to_disk()
+            self.unsaved_pieces += len(newly_completed)
             logger.debug("Bitfield updated!")
             logger.debug(
                 f"{self.total_downloaded_percentage():.2f}% downloaded (verified), {self.total_downloaded_unverified_percentage():.2f}% downloaded (unverified)"
@@ -126,9 +461,47 @@ class File:
             self.endgame_mode = True
             for piece in self.pieces:
                 piece.endgame_mode = True
+        if self.unsaved_pieces:
+            self.save_progress()
 
         return newly_completed
 
+    def collect_verifications(self):
+        """
+        Delivers the digests of pieces hashed in the background, which queues valid pieces for writing.
+        """
+        if self.verifier:
+            for index, digest in self.verifier.collect():
+                self.pieces[index].verification_finished(digest)
+
+    def collect_writes(self):
+        """
+        Informs pieces that their background writes have finished.
+        """
+        if self.writer:
+            for index, error in self.writer.collect():
+                piece = self.pieces[index]
+                # Peers request a new piece right after our HAVE, so keep its buffer to serve them from memory.
+                retain = not error and self.cache.insert(index, piece.pieceBuffer)
+                piece.write_finished(error, retain)
+
+    def flush(self):
+        """
+        Waits for all background hashing and writes to finish and records the pieces they completed.
+        """
+        if self.verifier:
+            self.verifier.wait()
+            self.collect_verifications()
+        if self.writer:
+            self.writer.wait()
+        self.update_bitfield()
+
+    def writes_backlogged(self) -> bool:
+        """
+        Returns True if the background write queue is full, in which case no new blocks should be requested.
+        """
+        return self.writer is not None and self.writer.full()
+
     def get_progress(self):
         return f"{self.total_downloaded_percentage():.2f}% ({self.bytes_downloaded() / 1_000_000:.2f} MB of {self.length / 1_000_000:.2f} MB)"
 
@@ -153,14 +526,71 @@ class File:
         return (self.bytes_downloaded_unverified() / self.length) * 100
 
     def missing_pieces(self):
-        """Returns a list of pieces that have not yet been fully downloaded and/or verified."""
-        return self.missing_pieces_set
+        """Returns a set of the wanted (not skipped) pieces that have not yet been fully downloaded and/or verified."""
+        return self.wanted_pieces
+
+    def priority_tiers(self) -> list[set[int]]:
+        """Returns the sets of missing wanted pieces of each priority, highest priority first, omitting empty sets."""
+        return [tier for tier in reversed(self.tiers[1:]) if tier]
+
+    def set_priority(self, start, end, level):
+        """
+        Sets the priority (one of PRIORITY_LEVELS) of the pieces holding bytes start up to end (exclusive) of the torrent.
+        A piece only partly inside the range keeps a higher priority it already has, since the rest of its data may still be wanted.
+        """
+        value = PRIORITY_LEVELS.index(level)
+        end = min(end, self.length)
+        if start >= end:
+            return
+        for index in range(start // self.piece_length, (end - 1) // self.piece_length + 1):
+            piece_start = index * self.piece_length
+            partial = piece_start < start or piece_start + self.pieces[index].length > end
+            self.move_to_tier(index, max(self.priorities[index], value) if partial else value)
+        logger.info(f"Set priority of bytes {start}-{end - 1} to {level}: {len(self.wanted_pieces)} wanted pieces missing.")
+
+    def move_to_tier(self, index, value):
+        if index in self.missing_pieces_set:
+            self.tiers[self.priorities[index]].discard(index)
+            self.tiers[value].add(index)
+            if value:
+                self.wanted_pieces.add(index)
+            else:
+                self.wanted_pieces.discard(index)
+        self.priorities[index] = value
+
+    def in_progress_pieces(self):
+        """Returns the set of pieces that have received some but not all of their blocks."""
+        return self.in_progress
+
+    def bytes_in_flight(self) -> int:
+        """Returns the number of bytes held in memory by pieces that have not yet been stored."""
+        return self.buffers.in_flight
+
+    def startable_pieces(self, assigned) -> int:
+        """
+        Returns how many more pieces may be started within the memory budget, given the indices of the pieces assigned to peers.
+        Pieces take their buffer when their first block arrives, so assigned pieces without one yet are counted as if they held it.
+        """
+        reserved = sum(self.pieces[index].length for index in assigned if self.pieces[index].pieceBuffer is None and not self.pieces[index].complete)
+        return max(0, (self.buffers.budget - self.buffers.in_flight - reserved) // self.piece_length)
 
     def initialize_missing_pieces(self):
+        """
+        Rebuilds the set of missing pieces and the progress counters from the bitfield. Afterwards they are kept up to date by update_bitfield().
+        """
         self.missing_pieces_set = set()
         for index, bit in enumerate(self.bitfield):
             if bit == 0:
                 self.missing_pieces_set.add(index)
+        self.tiers = [set() for _ in PRIORITY_LEVELS]  # Missing pieces by priority.
+        for index in self.missing_pieces_set:
+            self.tiers[self.priorities[index]].add(index)
+        self.wanted_pieces = self.missing_pieces_set - self.tiers[0]  # Missing pieces that are not skipped.
+        self.events.clear()
+        self.in_progress = {index for index, piece in enumerate(self.pieces) if piece.downloaded and not piece.complete}  # Partially downloaded pieces.
+        self.counted_bytes = [piece.downloaded for piece in self.pieces]  # Unverified bytes of each piece included in unverified_bytes.
+        self.unverified_bytes = sum(self.counted_bytes)
+        self.verified_bytes = sum(piece.length for piece, bit in zip(self.pieces, self.bitfield) if bit == 1)
 
     def has_pieces(self):
         """Returns a list of pieces that have been downloaded and verified."""
@@ -171,35 +601,30 @@ class File:
         return has
 
     def complete(self) -> bool:
-        """Returns True if file is complete, False otherwise."""
+        """Returns True if every wanted piece has been downloaded, False otherwise. Skipped pieces may still be missing."""
         return not self.missing_pieces()
 
+    def has_all_pieces(self) -> bool:
+        """Returns True if every piece, including skipped ones, has been downloaded."""
+        return not self.missing_pieces_set
+
     def bytes_left(self) -> int:
         """
         Returns the number of bytes this client still has left to download (based on verified data).
         """
-        logger.debug("Calculating bytes left...")
-        total = 0
-        for piece_index in self.missing_pieces():
-            total += self.pieces[piece_index].length
-        logger.debug(f"{total} bytes left")
-        return total
+        return self.length - self.verified_bytes
 
     def bytes_downloaded(self) -> int:
         """
         Returns the number of bytes this client has downloaded that have also been verified.
         """
-        total = sum(self.pieces[piece_index].length for piece_index in self.has_pieces())
-        logger.debug(f"{total} bytes downloaded")
-        return total
+        return self.verified_bytes
 
     def bytes_left_unverified(self):
         """
         Returns the number of bytes this client still has left to download (based on unverified data).
         """
-        total = self.length - self.bytes_downloaded_unverified()
-        logger.debug("{total} bytes left (based on unverified data)")
-        return total
+        return self.length - self.unverified_bytes
 
     def bytes_uploaded(self):
         logger.debug(f"{self.total_uploaded} bytes uploaded")
@@ -209,30 +634,103 @@ class File:
         """
         Returns the number of bytes this client still has downloaded (based on unverified data).
         """
-        total = 0
-        for piece in self.pieces:
-            total += piece.downloaded
-        logger.debug(f"{total} bytes downloaded (based on unverified data)")
-        return total
+        return self.unverified_bytes
 
     def get_data_from_piece(self, offset, length, index):
-        for i, piece in enumerate(self.pieces):
-            if i == index:
-                data = piece.get_data_from_file(offset, length)
-                return data
-        return 0
+        """
+        Returns length bytes at offset within piece index to upload to a peer, or 0 if they cannot be read.
+        Verified pieces are served from the cache, reading the whole piece on the first request since the rest of it is likely to be requested next.
+        Without room in the cache, a StorageRegion is returned so that the peer sends the bytes straight from storage with os.sendfile.
+        """
+        if not 0 <= index < len(self.pieces) or offset + length > self.pieces[index].length or index in self.corrupt or index in self.released:
+            return 0
+        if self.scrubber:
+            self.scrubber.uploading = True
+        piece = self.pieces[index]
+        if not self.bitfield[index]:
+            return piece.get_data_from_file(offset, length)
+        data = self.cache.get(index) if self.cache.budget else None
+        if data is None:
+            if piece.length > self.cache.budget and hasattr(os, "sendfile") and hasattr(self.storage, "sendfile"):
+                region = StorageRegion(self.storage, index * self.piece_length + offset, length)
+                self.uploads.add(region)
+                return region
+            data = piece.get_data_from_file(0, piece.length)
+            if data == 0:  # Issue reading from disk
+                return 0
+            self.cache.insert(index, data)
+        return memoryview(data)[offset : offset + length]
+
+    def prefetch_piece(self, index):
+        """
+        Called for pieces that peers have requested: asks the kernel to read the piece ahead so that serving its blocks does not wait on the disk.
+        """
+        if 0 <= index < len(self.pieces) and self.bitfield[index] and self.hints.prefetch(index):
+            self.advise(index * self.piece_length, self.pieces[index].length, "willneed")
+
+    def finished_serving(self, index):
+        """
+        Called once no peer has requests left for piece index. Drops the least recently served pieces from the page cache beyond its budget.
+        """
+        for dropped in self.hints.finished(index, self.pieces[index].length):
+            self.advise(dropped * self.piece_length, self.pieces[dropped].length, "dontneed")
+
+    def advise(self, offset, length, advice):
+        """
+        Passes access advice (see storage.FADVICE) for a range of the torrent to storage. Advice is only a hint, so failures are logged and ignored.
+        """
+        try:
+            self.storage.advise(offset, length, advice)
+        except (OSError, AttributeError) as e:
+            logger.debug(f"Could not advise {advice} for {length} bytes at {offset}: {e}")
 
     def rename(self, new):
         """Renames the file. Used when the download is complete to remove the temporary suffix."""
         old = self.torrent_path
-        os.rename(old, new)
+        if not self.volatile:
+            os.rename(old, new)
         self.torrent_path = new
         logger.info(f"Renamed file from '{old}' to '{new}'.")
 
     def remove_bitfield_from_disk(self):
+        if self.volatile:
+            return
         os.remove(self.bitfield_path)
         logger.info("Removed bitfield from disk.")
 
     def close_file(self):
-        if self.file:
-            self.file.close()
+        if self.scrubber:
+            self.scrubber.stop()
+            self.scrubber = None
+        if self.allocation_thread:  # The allocation thread must not outlive the file descriptor it is using.
+            self.allocation_thread.join()
+            self.allocation_thread = None
+        if self.verifier:  # Pieces still being hashed are queued for writing first.
+            self.verifier.shutdown()
+            self.collect_verifications()
+            self.verifier = None
+        if self.writer:  # Pending writes must land before their storage is closed.
+            self.writer.shutdown()
+            self.collect_writes()
+            self.writer = None
+        if self.storage and not self.volatile and self.checkpoint_partial_pieces():
+            self.storage.flush()  # The resume file records the data's modification time, so it must not change afterwards.
+            self.update_bitfield()
+            self.write_bitfield_to_disk()
+        if self.storage:
+            self.detach_uploads()
+            self.storage.close()
+            self.storage = None
+
+    def detach_uploads(self):
+        """
+        Reads the StorageRegions that peers have not finished sending into memory, as their storage is about to be closed and its
+        file descriptors may be reused.
+        """
+        for region in list(self.uploads):
+            try:
+                region.detach()
+            except OSError as e:
+                logger.error(f"Could not read {region.length} bytes queued for upload at {region.offset}: {e}")
+                region.storage = None  # Sending it fails, which disconnects the peer.
+        self.uploads.clear()
@@ -0,0 +1,49 @@
+from collections import OrderedDict
+from ..config import PAGE_CACHE_MB
+
+
+class PageCacheHints:
+    """
+    Decides which pieces to advise the kernel about while serving peers, so that seeding large torrents does not fill the page cache.
+    Pieces that peers have requested are read ahead. Pieces that have been served to every peer that requested them stay in the page cache,
+    least recently served first out, until they exceed budget bytes and are dropped. File applies the advice to storage.
+    """
+
+    def __init__(self, budget=PAGE_CACHE_MB * 1_048_576):
+        self.budget = budget
+        self.prefetched = set()  # Pieces read ahead that have not been dropped since.
+        self.served = OrderedDict()  # Piece index to length of served pieces left in the page cache, least recently served first.
+        self.size = 0  # Bytes of served pieces left in the page cache.
+        self.dropped = 0
+
+    def prefetch(self, index) -> bool:
+        """
+        Returns True if piece index, which a peer has requested, should be read ahead.
+        """
+        if index in self.prefetched:
+            return False
+        self.prefetched.add(index)
+        return True
+
+    def finished(self, index, length) -> list[int]:
+        """
+        Records that no peer has requests left for piece index. Returns the pieces to drop from the page cache to stay within budget.
+        """
+        if index in self.served:
+            self.served.move_to_end(index)
+        else:
+            self.served[index] = length
+            self.size += length
+        drop = []
+        while self.size > self.budget:
+            evicted, evicted_length = self.served.popitem(last=False)
+            self.size -= evicted_length
+            self.prefetched.discard(evicted)
+            drop.append(evicted)
+        self.dropped += len(drop)
+        return drop
+
+    def clear(self):
+        self.prefetched.clear()
+        self.served.clear()
+        self.size = 0
@@ -0,0 +1,110 @@
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from ..config import RECHECK_READ_BYTES
+from ..utils.helpers import logger
+
+
+class ContentImporter:
+    """
+    Finds missing pieces of a torrent in existing local files, such as an earlier release of the same data, and copies them into storage.
+    A candidate file is hashed piece by piece from its start, and also from the alignment at which each torrent file with the same name or
+    size would begin in it, so that a standalone copy of a file from a multi-file torrent is matched too. Every (candidate, alignment) pair
+    is scanned on a pool of threads, as hashlib releases the GIL while hashing.
+    """
+
+    def __init__(self, file, workers):
+        self.file = file  # Reads piece_length, pieces, hashes, bitfield, layout and storage.
+        self.workers = workers
+        self.lock = threading.Lock()  # Guards found and bytes_scanned.
+        self.found = set()  # Pieces copied into storage.
+        self.bytes_scanned = 0
+        self.files_scanned = 0
+        missing = [index for index, bit in enumerate(file.bitfield) if not bit]
+        # Digest to the missing pieces it belongs to. Only the last piece can be shorter, so it is looked up separately.
+        self.last = len(file.pieces) - 1
+        self.wanted = {}
+        for index in missing:
+            if index != self.last or file.pieces[index].length == file.piece_length:
+                self.wanted.setdefault(file.hashes[index], []).append(index)
+        self.wanted_last = file.hashes[self.last] if self.last in missing and file.pieces[self.last].length < file.piece_length else None
+
+    def run(self, paths) -> set[int]:
+        """
+        Scans every file at or below the given paths and returns the indices of the pieces found in them.
+        """
+        candidates = self.candidates(paths)
+        tasks = [(path, alignment) for path in candidates for alignment in self.alignments(path)]
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="importer") as executor:
+            list(executor.map(lambda task: self.scan(*task), tasks))
+        self.files_scanned = len(candidates)
+        return self.found
+
+    def candidates(self, paths) -> list[Path]:
+        """
+        Returns the regular files at or below the given paths, leaving out the download itself and its resume file.
+        """
+        own = {Path(self.file.torrent_path).resolve(), Path(self.file.bitfield_path).resolve()}
+        found = []
+        for path in map(Path, paths):
+            files = [path] if path.is_file() else sorted(child for child in path.rglob("*") if child.is_file())
+            if not files:
+                logger.warning(f"Nothing to import from '{path}'.")
+            for candidate in files:
+                resolved = candidate.resolve()
+                if not any(resolved == ours or ours in resolved.parents for ours in own):
+                    found.append(candidate)
+        return found
+
+    def alignments(self, path: Path) -> list[int]:
+        """
+        Returns the offsets within the candidate at which pieces are hashed from: its start, and where each torrent file it may be a copy of begins.
+        """
+        size = path.stat().st_size
+        alignments = {0}
+        for entry in self.file.layout.files:
+            if entry.length == size or (entry.path.name and entry.path.name == path.name):
+                alignments.add(-entry.offset % self.file.piece_length)
+        return sorted(alignments)
+
+    def scan(self, path: Path, alignment):
+        """
+        Hashes the candidate in piece-sized windows starting at alignment and copies every window matching a missing piece into storage.
+        """
+        piece_length = self.file.piece_length
+        read_bytes = max(1, RECHECK_READ_BYTES // piece_length) * piece_length
+        try:
+            with open(path, "rb") as f:
+                f.seek(alignment)
+                while data := f.read(read_bytes):
+                    view = memoryview(data)
+                    for start in range(0, len(view), piece_length):
+                        self.match(view[start : start + piece_length])
+                    with self.lock:
+                        self.bytes_scanned += len(data)
+        except OSError as e:
+            logger.warning(f"Could not import from '{path}': {e}")
+
+    def match(self, window: memoryview):
+        indices = []
+        if self.wanted_last is not None and len(window) >= self.file.pieces[self.last].length:
+            hasher = hashlib.sha1(window[: self.file.pieces[self.last].length])
+            if hasher.digest() == self.wanted_last:
+                indices.append(self.last)
+            hasher.update(window[self.file.pieces[self.last].length :])  # Reuses the hash of the prefix for the full window.
+            digest = hasher.digest()
+        else:
+            digest = hashlib.sha1(window).digest()
+        if len(window) == self.file.piece_length:
+            indices += self.wanted.get(digest, [])
+        with self.lock:
+            indices = [index for index in indices if index not in self.found]
+            self.found.update(indices)
+        for index in indices:
+            try:
+                self.file.storage.write(index * self.file.piece_length, window[: self.file.pieces[index].length])
+            except OSError as e:
+                logger.error(f"Could not import piece {index}: {e}")
+                with self.lock:
+                    self.found.discard(index)
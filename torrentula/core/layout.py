@@ -0,0 +1,85 @@
+from bisect import bisect_right
+from pathlib import Path
+
+
+class FileEntry:
+    """
+    A single file within a torrent, located at a byte offset of the torrent's concatenated data.
+    """
+
+    def __init__(self, path: Path, length: int, offset: int):
+        self.path = path  # Relative to the torrent's root (empty for single-file torrents).
+        self.length = length
+        self.offset = offset
+
+    def __str__(self):
+        return f"FileEntry(path={self.path}, length={self.length}, offset={self.offset})"
+
+
+class Layout:
+    """
+    Maps byte ranges of a torrent's concatenated data onto the files that hold them.
+    File start offsets are precomputed so that the file containing any offset is found with a binary search.
+    """
+
+    def __init__(self, files: list[FileEntry], piece_length: int):
+        self.files = files
+        self.piece_length = piece_length
+        self.starts = [entry.offset for entry in files]
+        self.length = sum(entry.length for entry in files)
+        self.multi_file = len(files) != 1 or files[0].path != Path()
+
+    @classmethod
+    def for_single_file(cls, length, piece_length):
+        return cls([FileEntry(Path(), length, 0)], piece_length)
+
+    @classmethod
+    def for_files(cls, files: list[tuple[Path, int]], piece_length):
+        """
+        Builds a layout from (relative path, length) pairs in the order they appear in the torrent's info dictionary.
+        """
+        entries = []
+        offset = 0
+        for path, length in files:
+            entries.append(FileEntry(path, length, offset))
+            offset += length
+        return cls(entries, piece_length)
+
+    def paths(self, root: Path) -> list[Path]:
+        """
+        Returns the location of every file when the torrent's root (the file itself for single-file torrents) is at root.
+        """
+        return [root / entry.path for entry in self.files]
+
+    def spans(self, offset, length) -> list[tuple[int, int, int]]:
+        """
+        Splits a byte range of the torrent into (file index, file offset, length) segments, in order.
+        """
+        segments = []
+        index = bisect_right(self.starts, offset) - 1
+        while length > 0 and index < len(self.files):
+            entry = self.files[index]
+            file_offset = offset - entry.offset
+            span = min(length, entry.length - file_offset)
+            if span > 0:  # Zero-length files hold no data.
+                segments.append((index, file_offset, span))
+                offset += span
+                length -= span
+            index += 1
+        return segments
+
+    def piece_spans(self, index, offset, length) -> list[tuple[int, int, int]]:
+        """
+        Splits a block of a piece into (file index, file offset, length) segments.
+        """
+        return self.spans(index * self.piece_length + offset, length)
+
+
+def decode_path(components: list[bytes]) -> Path:
+    """
+    Converts the path list of a multi-file torrent entry into a relative path, rejecting components that would escape the download directory.
+    """
+    parts = [component.decode("utf-8") for component in components]
+    if not parts or any(part in ("", ".", "..") or "/" in part or "\\" in part for part in parts):
+        raise ValueError(f"Invalid file path in torrent: {parts}")
+    return Path(*parts)
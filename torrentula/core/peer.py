@@ -1,14 +1,15 @@
 from datetime import datetime, timedelta
 from enum import Enum, auto
-from ..config import PEER_INACTIVITY_TIMEOUT_SECS, MAX_PEER_OUTSTANDING_REQUESTS, LOOPBACK_IP
+from ..config import PEER_INACTIVITY_TIMEOUT_SECS, MAX_PEER_OUTSTANDING_REQUESTS, LOOPBACK_IP, SEND_TIMEOUT_SECS
 from ..utils.helpers import logger, Status
 from .piece import Piece
-from .block import Block
+from .transfer import SendQueue
 import select
 import socket
 import struct
 import random
 import errno
+from collections import Counter
 
 
 class MessageType(Enum):
@@ -142,6 +143,7 @@ class Peer:
         # Track statistics *per epoch* to inform strategic decision-making.
         self.bytes_received = 0
         self.bytes_sent = 0
+        self.bytes_wasted = 0  # Payload of blocks that arrived after another copy or once the piece was no longer needed
         self.kilobytes_received = 0  # Never reset
         self.kilobytes_sent = 0  # Never reset
         self.download_speed = 0
@@ -154,6 +156,8 @@ class Peer:
 
         self.outgoing_requests = set()  # List of pieces that we have requested from the peer but have not completed.
         self.incoming_requests = []  # list of incoming requests
+        self.requested_pieces = Counter()  # piece index to the number of incoming requests queued for it
+        self.newly_requested = []  # pieces the peer started requesting since the client last read them ahead
         self.target_piece = None  # Piece from peer we are currently requesting, is an int index.
         self.last_received = None  # Time of last message received from peer
         self.last_sent = None  # Time of last message sent to peer
@@ -161,6 +165,8 @@ class Peer:
         self.received_handshake = Handshake.HANDSHAKE_NOT_RECVD  # check if we recieved a handshake or not
         self.info_hash: bytes = info_hash  # we keep an info hash here to send and check when received
         self.peer_id: str = peer_id  # we keep a peer_id here in the case of them receiving
+        self.remote_peer_id: bytes = None  # the peer_id the peer sent in its handshake
+        self.corrupt_pieces = 0  # pieces the peer was found to have sent corrupt data for, never reset
         self.sent_handshake = False  # needed to differentiate if we initiate or they initiate connection
         self.can_send_bitfield = False  # client checks and handles sending bitfields
         self.tcp_established = False  # self explanatory, if we have a socket and this is false, connection is ongoing
@@ -175,8 +181,11 @@ class Peer:
         self.msg_len_loaded_bytes = 0
         self.loaded_bytes = 0
 
+        self.send_queue = SendQueue()  # Data the socket has not accepted yet, see flush_sends().
+
         # if we pass in a socket we are already connected, send handshake
         if sock is not None:
+            sock.setblocking(False)  # Like the sockets we connect, so that sending never blocks the event loop.
             self.last_sent = datetime.now()
             self.last_received = datetime.now()
             self.record_tcp_established()
@@ -229,12 +238,16 @@ class Peer:
         # Track statistics *per epoch* to inform strategic decision-making.
         self.bytes_received = 0
         self.bytes_sent = 0
+        self.bytes_wasted = 0
         self.download_speed = 0
         self.upload_speed = 0
         self.is_seeder = False
         self.outgoing_requests = set()  # List of pieces that we have requested from the peer but have not completed.
         self.incoming_requests = []  # list of incoming requests
+        self.requested_pieces = Counter()
+        self.newly_requested = []
         self.target_piece = None  # Piece from peer we are currently requesting, is an int index.
+        self.send_queue = SendQueue()
 
         self.received_handshake = Handshake.HANDSHAKE_NOT_RECVD  # check if we recieved a handshake or not
         self.sent_handshake = False  # needed to differentiate if we initiate or they initiate connection
@@ -314,15 +327,15 @@ class Peer:
                     return Status.FAILURE
             try:
                 while self.loaded_bytes < self.msg_len:
-                    section = self.socket.recv(self.msg_len - self.loaded_bytes)
-                    # recv returns an empty bytes object when the connection is closed
-                    if len(section) == 0:
+                    # receive straight into the message buffer rather than into a temporary bytes object
+                    received = self.socket.recv_into(memoryview(self.msg_buffer)[self.loaded_bytes : self.msg_len])
+                    # recv returns 0 bytes when the connection is closed
+                    if received == 0:
                         logger.debug(f"connection closed, disconnecting")
                         self.disconnect()
                         return Status.FAILURE
 
-                    self.msg_buffer[self.loaded_bytes : self.loaded_bytes + len(section)] = section
-                    self.loaded_bytes += len(section)
+                    self.loaded_bytes += received
             except BlockingIOError as e:
                 logger.debug(f"waiting for next part of message, {self.loaded_bytes}/{self.msg_len}...")
                 return Status.IN_PROGRESS
@@ -360,7 +373,7 @@ class Peer:
                 elif msg_type == MessageType.REQUEST.value:
                     index, offset, length = struct.unpack(f"!III", self.msg_buffer[1 : self.msg_len])
                     logger.debug(f"recieved request for index: {index}, offset {offset}, length: {length}")
-                    self.incoming_requests.append((index, offset, length))
+                    self.queue_request((index, offset, length))
                 elif msg_type == MessageType.PIECE.value:
                     # if we passed in a piece that is not none
                     if piece and not piece.complete:
@@ -374,15 +387,31 @@ class Peer:
                         tup = (index, offset, length)
                         if tup in self.outgoing_requests:
                             self.outgoing_requests.remove(tup)
-                            if piece.add_block(offset, self.msg_buffer[9 : self.msg_len]) >= 0:
-                                self.bytes_received += length
+                            # the piece copies the block out of the message buffer, so a view avoids an intermediate copy
+                            if index != piece.index:  # requested for a piece this peer is no longer assigned to
+                                logger.debug(f"Discarding block of piece {index}, peer is now assigned piece {piece.index}")
+                                self.bytes_wasted += length
+                            else:
+                                holders = piece.take_holders(offset)
+                                result = piece.add_block(offset, memoryview(self.msg_buffer)[9 : self.msg_len], self)
+                                if result == -2:  # another peer's copy arrived first
+                                    self.bytes_wasted += length
+                                else:
+                                    if result >= 0:
+                                        self.bytes_received += length
+                                    # the first copy is in, other peers asked for the block (endgame mode) need not send theirs
+                                    for holder in holders:
+                                        if holder is not self:
+                                            holder.send_cancel(index, offset, length)
+                    else:  # the piece was completed by other peers or the peer is no longer assigned to it
+                        self.bytes_wasted += self.msg_len - 9
                 elif msg_type == MessageType.CANCEL.value:
                     info = self.msg_buffer[1 : self.msg_len]
                     index, offset, length = struct.unpack(f"!III", info)
                     tup = (index, offset, length)
                     logger.debug(f"recieved cancel for index: {index}, offset {offset}, length: {length}")
                     if tup in self.incoming_requests:
-                        self.incoming_requests.remove(tup)
+                        self.drop_request(tup)
                 elif msg_type == MessageType.PORT.value:
                     pass
                 elif msg_type == MessageType.HAVE_ALL.value:
@@ -427,6 +456,7 @@ class Peer:
             logger.error(f"info hash doesn't match up, failed")
             self.disconnect()
             return Status.FAILURE
+        self.remote_peer_id = peer_id
         self.received_handshake = Handshake.CAN_RECV_BITFIELD
         # if the connection was an incoming connection we still need to send our side of the handshake
         if not self.sent_handshake:
@@ -492,19 +522,33 @@ class Peer:
         return self.send_msg(msg)
 
     def send_piece(self, index, offset, data):
-        """sends data, passed in as bytes, as well as the index and offset of it
+        """sends data, passed in as a bytes-like object or a StorageRegion, as well as the index and offset of it
         also takes care of the incoming requests list, if it wasn't in there, fail"""
         tup = (index, offset, len(data))
         if tup in self.incoming_requests:
             msg_len = len(data) + 9
-            msg = struct.pack(f"!IBII{len(data)}s", msg_len, MessageType.PIECE.value, index, offset, data)
-            self.incoming_requests.remove(tup)
-            res = self.send_msg(msg)
+            header = struct.pack(f"!IBII", msg_len, MessageType.PIECE.value, index, offset)
+            self.drop_request(tup)
+            res = self.send_msg_zero_copy(header, data)
             if res == Status.SUCCESS:
                 self.bytes_sent += len(data)
             return res
         return Status.FAILURE
 
+    def queue_request(self, request):
+        """Queues an (index, offset, length) request the peer sent and counts it against its piece."""
+        self.incoming_requests.append(request)
+        if not self.requested_pieces[request[0]]:
+            self.newly_requested.append(request[0])
+        self.requested_pieces[request[0]] += 1
+
+    def drop_request(self, request):
+        """Removes a queued request that was served, cancelled or refused."""
+        self.incoming_requests.remove(request)
+        self.requested_pieces[request[0]] -= 1
+        if not self.requested_pieces[request[0]]:
+            del self.requested_pieces[request[0]]
+
     def send_cancel(self, index, offset, length):
         """Also takes care of the outgoing requests list, if we didn't request it before, fail"""
         tup = (index, offset, length)
@@ -535,13 +579,55 @@ class Peer:
         logger.debug(msg)
         self.last_sent = datetime.now()
         try:
-            self.socket.sendall(msg)
+            self.send_queue.send(self.socket, [msg])
         except Exception as e:
             logger.debug("message failed to send, disconnecting")
             self.disconnect()
             return Status.FAILURE
         return Status.SUCCESS
 
+    def send_msg_zero_copy(self, header, payload):
+        """
+        Sends a message header followed by its payload without copying the payload into a new message.
+        Payloads in memory are sent with sendmsg together with the header, a StorageRegion is sent from disk with os.sendfile.
+        Whatever the socket does not accept at once is queued (see flush_sends()). Will disconnect if send fails, returns either success or failure.
+        """
+        if not self.tcp_established or not self.socket:
+            logger.error(f"Peer at {self.addr}: send_msg_zero_copy was called with is_connected={self.tcp_established}, socket={self.socket}")
+            return Status.FAILURE
+        self.can_send_bitfield = False
+        self.last_sent = datetime.now()
+        try:
+            self.send_queue.send(self.socket, [header, payload])
+        except Exception as e:
+            logger.debug(f"message failed to send ({e}), disconnecting")
+            self.disconnect()
+            return Status.FAILURE
+        return Status.SUCCESS
+
+    def flush_sends(self):
+        """
+        Sends more of the data queued for a socket that did not accept it at once. Called once per event loop iteration.
+        Disconnects the peer if the socket accepted none of it for SEND_TIMEOUT_SECS.
+        """
+        if not self.send_queue.items or not self.socket:
+            return
+        try:
+            self.send_queue.flush(self.socket)
+        except Exception as e:
+            logger.debug(f"queued data failed to send ({e}), disconnecting")
+            self.disconnect()
+            return
+        if self.send_queue.stalled_for() >= SEND_TIMEOUT_SECS:
+            logger.info(f"Peer at {self.addr} accepted none of {self.send_queue.size} queued bytes for {SEND_TIMEOUT_SECS}s, disconnecting")
+            self.disconnect()
+
+    def sending(self) -> bool:
+        """
+        Returns True while data is queued for the peer, in which case no more uploads should be queued behind it.
+        """
+        return bool(self.send_queue.items)
+
     def choke(self):
         """
         Sends a choke message to peer and stores that state if peer is currently unchoked. Otherwise, does nothing.
@@ -577,6 +663,7 @@ class Peer:
         self.kilobytes_sent += self.bytes_sent / 1024
         self.bytes_received = 0
         self.bytes_sent = 0
+        self.bytes_wasted = 0
         return res
 
     def disconnect_if_timeout(self):
@@ -1,7 +1,7 @@
 import hashlib
-from .block import Block
+import heapq
 import time
-from io import BufferedRandom
+from collections import deque
 from ..utils.helpers import logger, Status
 from ..config import PIECE_TIMEOUT_SECS
 
@@ -17,9 +17,13 @@ Interface
     @info: gets the next request for a piece to send to a peer 
     @return: tuple (offset to request, length to request)
 
-    add_block()
-    @info: adds block after receiving to data structure and when complete will write to disk and verifys with hash
-    @returns: -1 if invalid hash (need to restart), 1 if added block successfully but not complete yet, 0 if added block and complete and done 
+    get_next_requests(count)
+    @info: gets up to count requests for a piece to send to a peer in one call
+    @return: list of tuples (offset to request, length to request)
+
+    add_block(offset, data, source=None)
+    @info: copies a received block (from the peer source) into the piece buffer at its offset and when complete will write to disk and verifys with hash
+    @returns: -1 if invalid hash (need to restart), 1 if added block successfully but not complete yet, 0 if added block and complete and done, -2 if the block was already received
 
     get_download_percent()
     @info Returns the percent of how close it is to downloading out of 100
@@ -27,7 +31,7 @@ Interface
 
     get_data_from_file(offset,blockLength)
     @info gets the data in bytes that a peer requests from disk
-    @returns the data in bytes
+    @returns the data in bytes (a memoryview of the mapping when using mmap storage)
     
     __str__()
     @Info toString
@@ -36,109 +40,174 @@ Interface
 
 
 class Piece:
-    def __init__(self, index, length, hash, torrentLength, torrentPath, fileDesc: BufferedRandom):
+    def __init__(self, index, length, hash, torrentLength, torrentPath, storage, writer=None, verifier=None, events=None, buffers=None, blame=None):
         self.index = index  # index of piece
+        self.events = events  # queue shared with File, receives the index of this piece whenever its progress changes
+        self.blame = blame  # queue shared with File, receives (index, peer) whenever a peer is found to have sent corrupt data for this piece
         self.length = length  # length of entire piece (will be different for last piece)
         self.default_piece_length = length  # default piece length for index calculation, we only change self.length after the constructor
-        # blocks dictonary only used for reciving data key = offset, value = block class(data,length) however most ask for 16kb
-        self.blocks = {}
-        self.complete = False  # flag to indicate whether all blocks of the piece are present
+        self.buffers = buffers  # BufferPool the piece buffer is taken from and returned to, a new buffer is allocated if None
+        self.received = None  # one flag per block, set once the block has been copied into pieceBuffer (allocated with the buffer)
+        self.sources = None  # the peer each block in pieceBuffer came from, kept until the piece has been verified
+        self.hash_failures = 0  # number of downloads of this piece that failed the hash check
+        self.failed_blocks = {}  # key = offset value = list of (block hash, peer) for the copies of that block in downloads that failed the hash check
+        self.owner = None  # after a hash failure the piece is downloaded again from this peer only (chosen by Client)
+        self._complete = False  # flag to indicate whether all blocks of the piece are present
         self.hash = hash  # hash of entire piece from torrent file
-        self.downloaded = 0  # is increased until it == length of piece
-        self.pieceBuffer = None  # buffer for after its completed
-        self.pendingRequests = {}  # key = offset value = timestamp keeps track of the offsets we have asked for
+        self._downloaded = 0  # is increased until it == length of piece
+        self.pieceBuffer = None  # buffer that blocks are placed into as they arrive, held until the piece is stored
+        self.hasher = hashlib.sha1()  # running hash of the contiguous blocks received from the start of the piece
+        self.hashed = 0  # number of bytes from the start of the piece fed into hasher
+        self.freeBlocks = None  # offsets of blocks not requested yet, built on the first request as self.length changes after the constructor
+        self.pendingRequests = {}  # key = offset value = deadline of the outstanding request for that block
+        self.timeouts = []  # min-heap of (deadline, offset) of pendingRequests, entries that were replaced or answered are dropped when popped
+        self.holders = {}  # key = offset value = set of peers we have sent a request for that block, more than one in endgame mode or after a timeout
         self.torrentLength = torrentLength  # length listed in torrent file
         self.torrentPath = torrentPath
-        self.fileDesc = fileDesc  # file to write to
+        self.storage = storage  # storage backend (see storage.py) holding the torrent data
+        self.writer = writer  # DiskWriter that stores verified pieces in the background, pieces are written synchronously if None
+        self.writing = False  # True while the verified piece is queued for or being written by the writer
+        self.verifier = verifier  # PieceVerifier that hashes completed pieces in the background, pieces are hashed synchronously if None
+        self.verifying = False  # True while the completed piece is queued for or being hashed by the verifier
 
         # endgame mode stuff
         self.endgame_mode = False
-        self.endgame_mode_offsets = set(range(0, self.length, BLOCK_SIZE))
+        self.endgame_mode_offsets = set()  # filled with the missing blocks when endgame mode first needs them
+
+    @property
+    def complete(self):
+        return self._complete
+
+    @complete.setter
+    def complete(self, value):
+        self._complete = value
+        self._notify()
+
+    @property
+    def downloaded(self):
+        return self._downloaded
+
+    @downloaded.setter
+    def downloaded(self, value):
+        self._downloaded = value
+        self._notify()
+
+    # tells File that this piece changed so it can update its counters without scanning every piece
+    def _notify(self):
+        if self.events is not None:
+            self.events.append(self.index)
 
     # gets the next offset and length to ask the peer for a specified client this is on the assumtion that we will always ask for 16kb incriments which is standard
     # return a tuple (offset to request, length to request)
     def get_next_request(self):
+        requests = self.get_next_requests(1)
+        if not requests:
+            logger.debug("All requests for this piece are currently allocated to peers.")
+            return (None, None)
+        return requests[0]
+
+    # gets up to count requests to send to a peer at once, blocks never asked for come first then blocks whose request timed out
+    # in endgame mode blocks already asked for are added too, each at most once per call
+    # returns a list of tuples (offset to request, length to request)
+    def get_next_requests(self, count):
         if self.complete:
             logger.debug("Request for a piece already complete.")
-            return (None, None)
-        if self.length < BLOCK_SIZE:  # if last piece is smaller than the block size
-            if 0 not in self.blocks:
-                self.pendingRequests[0] = time.time()
-                logger.debug(f"Last piece is smaller than block, returning: 0 {self.length}")
-                return (0, self.length)
-            logger.debug("Last piece is smaller than block, returning: None None")
-            return (None, None)
+            return []
+        if self.freeBlocks is None:
+            self.freeBlocks = deque(range(0, self.length, BLOCK_SIZE))
+        now = time.monotonic()
+        requests = []
+        while len(requests) < count:
+            offset = self._allocate_block(now)
+            if offset is None:
+                break
+            requests.append((offset, min(BLOCK_SIZE, self.length - offset)))
 
-        for offset in range(0, self.length, BLOCK_SIZE):
-            if offset not in self.blocks:  # checks whats the next request I have yet to recive
-                if self._check_if_already_asked(offset):  # checks last request time
-                    lastLength = self.length - offset
-                    lengthToReturn = BLOCK_SIZE
-                    if lastLength < BLOCK_SIZE:
-                        lengthToReturn = lastLength
-                    # add to pending requests or update time
-                    self.pendingRequests[offset] = time.time()
-                    logger.debug(f"Return value: {offset} {lengthToReturn}")
-                    return (offset, lengthToReturn)
-        
         # in endgame mode we ignore already asked limitations
-        if self.endgame_mode:
+        if self.endgame_mode and len(requests) < count:
             # reset set if empty with unfulfilled blocks
             if not self.endgame_mode_offsets:
-                self.endgame_mode_offsets = set(range(0, self.length, BLOCK_SIZE)) - set(self.blocks.keys())
-
-            offset = self.endgame_mode_offsets.pop()
-            lastLength = self.length - offset
-            lengthToReturn = BLOCK_SIZE
-            if lastLength < BLOCK_SIZE:
-                lengthToReturn = lastLength
-            # add to pending requests or update time
-            self.pendingRequests[offset] = time.time()
-            logger.debug(f"Return value: {offset} {lengthToReturn}")
-            return (offset, lengthToReturn)
-
-        logger.debug("All requests for this piece are currently allocated to peers.")
-        return (None, None)
-
-    # checks if its been to long since it requested this block if so needs to re request it (helper function)
-    # returns true if it needs to be requested
-    def _check_if_already_asked(self, offset):
-        if offset not in self.pendingRequests:
-            logger.debug("Not already pending this request")
-            return True
-        else:
-            # checks if timestamp is still valid
-            timeSinceRequest = time.time() - self.pendingRequests[offset]
-            if timeSinceRequest > TIME_OUT:
+                self.endgame_mode_offsets = {offset for offset in range(0, self.length, BLOCK_SIZE) if not self._has_block(offset)}
+            while len(requests) < count and self.endgame_mode_offsets:
+                offset = self.endgame_mode_offsets.pop()
+                if self._has_block(offset) or offset in (request[0] for request in requests):
+                    continue
+                self._add_pending(offset, now)
+                requests.append((offset, min(BLOCK_SIZE, self.length - offset)))
+        logger.debug(f"Return value: {requests}")
+        return requests
+
+    # takes the next block that has never been requested, or else the block whose request expired first (helper function)
+    # returns the offset of the block or None if every missing block has a request outstanding
+    def _allocate_block(self, now):
+        while self.freeBlocks:
+            offset = self.freeBlocks.popleft()
+            if not self._has_block(offset):
+                self._add_pending(offset, now)
+                return offset
+        while self.timeouts and self.timeouts[0][0] <= now:
+            deadline, offset = heapq.heappop(self.timeouts)
+            if self.pendingRequests.get(offset) == deadline:  # otherwise the block arrived or was requested again since
                 logger.debug("Timeout on this request")
-                return True
-            return False
+                self._add_pending(offset, now)
+                return offset
+        return None
+
+    # records a request for the block at offset that expires after TIME_OUT (helper function)
+    def _add_pending(self, offset, now):
+        deadline = now + TIME_OUT
+        self.pendingRequests[offset] = deadline
+        heapq.heappush(self.timeouts, (deadline, offset))
+
+    # records that a request for the block at offset was sent to peer
+    def add_holder(self, offset, peer):
+        self.holders.setdefault(offset, set()).add(peer)
 
-    # adds block to block data-structure
+    # returns the peers that were asked for the block at offset and forgets them, called when the block arrives so the others can be sent a cancel
+    def take_holders(self, offset):
+        return self.holders.pop(offset, set())
+
+    # copies block into the piece buffer at its offset, data may be a memoryview of the receive buffer
     # returns -1 if invalid hash (need to restart), 1 if added block successfully but not complete yet, 0 if added block and complete and done
-    def add_block(self, offset, data):
+    def add_block(self, offset, data, source=None):
         # if we already have the block return -2
-        if offset in self.blocks:
+        if self._has_block(offset):
             return -2
         logger.debug("Attempting to add block")
-        blocktoAdd = Block(len(data), data)
-        self.blocks[offset] = blocktoAdd
+        if self.pieceBuffer is None:
+            self.pieceBuffer = self.buffers.acquire(self.length) if self.buffers else bytearray(self.length)
+            self.received = bytearray((self.length + BLOCK_SIZE - 1) // BLOCK_SIZE)
+            self.sources = [None] * len(self.received)
+        self.pieceBuffer[offset : offset + len(data)] = data
+        self.received[offset // BLOCK_SIZE] = 1
+        self.sources[offset // BLOCK_SIZE] = source
+        self.pendingRequests.pop(offset, None)
         self.downloaded += len(data)
+        if self.downloaded < self.length:
+            self._hash_contiguous()
 
         # checks if its done downloading
         if self.downloaded == self.length:
             self.complete = True
             self.pendingRequests = None  # frees pending requests
-            self._form_buffer()  # forms buffer of everything and frees blocks data structure
-            if not self._is_valid():  # checks if its valid
+            self.timeouts = []
+            self.freeBlocks = None
+            self.received = None
+            if self.verifier and self.length - self.hashed > BLOCK_SIZE:  # blocks arrived out of order, catch up on the hash in the background
+                self.verifying = True
+                if self.verifier.shares_memory:  # a worker thread can continue the running hash
+                    self.verifier.submit(self.index, memoryview(self.pieceBuffer)[self.hashed :], self.hasher)
+                else:
+                    self.verifier.submit(self.index, self.pieceBuffer)
+                logger.debug("Download done, awaiting verification")
+                return 0
+            if self._finish_hash() != self.hash:  # checks if its valid
                 # something happended its not valid for whatever reason reset everything
-                self.blocks = {}
-                self.pendingRequests = {}
-                self.pieceBuffer = None
-                self.downloaded = 0
-                self.complete = False
+                self._hash_failed()
+                self.reset()
                 logger.debug("Download done but invalid hash")
                 return -1
+            self._hash_passed()
             self._write_to_disk()
             logger.debug("Download done and valid")
             return 0
@@ -153,9 +222,7 @@ class Piece:
     def get_data_from_file(self, offset, blockLength):
         logger.debug("Attempting get_data_from_file()")
         try:
-
-            self.fileDesc.seek((self.index * self.default_piece_length) + offset)
-            data = self.fileDesc.read(blockLength)
+            data = self.storage.read((self.index * self.default_piece_length) + offset, blockLength)
             logger.debug("get_data_from_file retunred data")
             return data
         except Exception as e:
@@ -163,6 +230,94 @@ class Piece:
             logger.debug("Error reading from disk")
             return 0
 
+    def received_ranges(self):
+        """
+        Returns the (start, end) byte ranges within the piece of runs of consecutive blocks that have been received.
+        """
+        ranges = []
+        if self.complete or self.received is None:
+            return ranges
+        for block, flag in enumerate(self.received):
+            if not flag:
+                continue
+            start = block * BLOCK_SIZE
+            end = min(start + BLOCK_SIZE, self.length)
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def restore_blocks(self, received):
+        """
+        Rebuilds a partially downloaded piece from the blocks a previous session wrote to storage, so that only the missing blocks are requested.
+        received has one flag per block. The restored blocks are checked along with the rest of the piece once it is complete.
+        """
+        blocks = (self.length + BLOCK_SIZE - 1) // BLOCK_SIZE
+        if self.complete or len(received) != blocks or all(received) or not any(received):
+            return
+        self.pieceBuffer = self.buffers.acquire(self.length) if self.buffers else bytearray(self.length)
+        self.received = bytearray(received)
+        self.sources = [None] * blocks
+        downloaded = 0
+        for start, end in self.received_ranges():
+            self.pieceBuffer[start:end] = self.storage.read(self.index * self.default_piece_length + start, end - start)
+            downloaded += end - start
+        self.downloaded = downloaded
+        self._hash_contiguous()
+
+    def reset(self):
+        """
+        Discards all downloaded data so that the piece is requested again from scratch.
+        """
+        self._release_buffer()
+        self.received = None
+        self.sources = None
+        self.owner = None
+        self.hasher = hashlib.sha1()
+        self.hashed = 0
+        self.freeBlocks = None
+        self.pendingRequests = {}
+        self.timeouts = []
+        self.holders = {}
+        self.endgame_mode_offsets = set()
+        self.downloaded = 0
+        self.complete = False
+        self.writing = False
+        self.verifying = False
+
+    def verification_finished(self, digest):
+        """
+        Called by File once the verifier has hashed this piece. Valid pieces are written to disk, invalid ones are downloaded again.
+        """
+        self.verifying = False
+        if digest != self.hash:
+            self._hash_failed()
+            self.reset()
+            logger.debug("Download done but invalid hash")
+            return
+        self._hash_passed()
+        self._write_to_disk()
+        self._notify()  # the piece is stored now unless it is being written in the background
+        logger.debug("Download done and valid")
+
+    def stored(self):
+        """
+        Returns True once the piece has been downloaded, verified and written to storage.
+        """
+        return self.complete and not self.verifying and not self.writing
+
+    def write_finished(self, error=None, retain=False):
+        """
+        Called by File once the writer has finished storing this piece. A failed write is downloaded again.
+        retain is True if File kept the buffer (to cache it), in which case it is not reused for another piece.
+        """
+        self.writing = False
+        self._release_buffer(reuse=not retain)  # The data now lives in storage.
+        if error:
+            self.reset()
+        self._notify()
+
     def set_complete_from_prev_download(self):
         """
         sets a piece to complete. This may be used to set a piece to complete based on a previous download
@@ -170,37 +325,85 @@ class Piece:
         self.downloaded = self.length
         self.complete = True
 
-    # forms complete buffer with data in block datastructure (helper fucntion)
-    def _form_buffer(self):
-        logger.debug("Attempting form_buffer")
-        self.pieceBuffer = bytearray(self.length)
-        for offset, block in self.blocks.items():
-            self.pieceBuffer[offset : offset + block.get_length()] = block.get_data()
-        self.blocks = {}
+    # checks whether the block at offset has been received (helper function)
+    def _has_block(self, offset):
+        if self.complete:
+            return True
+        return self.received is not None and self.received[offset // BLOCK_SIZE] == 1
+
+    # returns the piece buffer to the pool, it is not reused if a worker may still be using it (helper function)
+    def _release_buffer(self, reuse=True):
+        if self.pieceBuffer is not None and self.buffers:
+            self.buffers.release(self.pieceBuffer, reuse=reuse and not self.verifying and not self.writing)
+        self.pieceBuffer = None
+
+    # feeds blocks into the running hash as soon as every block before them has arrived (helper function)
+    def _hash_contiguous(self):
+        while self.hashed < self.length and self.received[self.hashed // BLOCK_SIZE]:
+            end = min(self.hashed + BLOCK_SIZE, self.length)
+            self.hasher.update(memoryview(self.pieceBuffer)[self.hashed : end])
+            self.hashed = end
 
-    # checks if the completed block matches the hash, pulls from memory (helper fucntion)
-    def _is_valid(self):
-        return hashlib.sha1(self.pieceBuffer).digest() == self.hash
+    # hashes any blocks the running hash has not reached yet and returns the digest of the piece (helper function)
+    def _finish_hash(self):
+        if self.hashed < self.length:
+            self.hasher.update(memoryview(self.pieceBuffer)[self.hashed : self.length])
+            self.hashed = self.length
+        return self.hasher.digest()
+
+    # records who sent the corrupt download before it is discarded (helper function)
+    # a single peer that sent every block is blamed at once, otherwise the hash of each block is kept to compare against once a valid copy arrives
+    # blocks of unknown source (restored from the journal) may be the corrupt ones, so a piece holding any is never blamed on a peer at once
+    def _hash_failed(self):
+        self.hash_failures += 1
+        sources = self.sources or []
+        contributors = {source for source in sources if source is not None}
+        logger.info(f"Piece {self.index} failed the hash check ({self.hash_failures} failures), its blocks came from {len(contributors)} peers")
+        if len(contributors) == 1 and None not in sources:
+            self._blame(contributors.pop())
+            return
+        for block, source in enumerate(sources):
+            if source is not None:
+                offset = block * BLOCK_SIZE
+                digest = hashlib.sha1(memoryview(self.pieceBuffer)[offset : min(offset + BLOCK_SIZE, self.length)]).digest()
+                self.failed_blocks.setdefault(offset, []).append((digest, source))
+
+    # blames the peers whose copy of a block differs from the verified piece (helper function)
+    def _hash_passed(self):
+        guilty = set()
+        for offset, copies in self.failed_blocks.items():
+            digest = hashlib.sha1(memoryview(self.pieceBuffer)[offset : min(offset + BLOCK_SIZE, self.length)]).digest()
+            guilty.update(source for copy, source in copies if copy != digest)
+        for peer in guilty:
+            self._blame(peer)
+        self.failed_blocks = {}
+        self.sources = None
+        self.owner = None
+
+    # reports a peer that sent corrupt data for this piece to File (helper function)
+    def _blame(self, peer):
+        if self.blame is not None:
+            self.blame.append((self.index, peer))
 
     # writes offset of piece to file from recived response from peer
     def _write_to_disk(self):
         logger.debug("Attempting write_to_disk")
+        if self.writer:
+            self.writing = True
+            self.writer.submit(self.index, self.index * self.default_piece_length, self.pieceBuffer)
+            return
+        if self.pieceBuffer is None:  # already written and released
+            return
         try:
-
-            self.fileDesc.seek(self.index * self.default_piece_length)
-            self.fileDesc.write(self.pieceBuffer)
+            self.storage.write(self.index * self.default_piece_length, self.pieceBuffer)
         except Exception as e:
             print("Error writing to disk: " + str(e))
             logger.debug("Error writing to disk")
+        self._release_buffer()
 
     # returns string for debugging
     def __str__(self):
-        if self.blocks is None:
+        if self.complete:
             return "Already completed"
-        info = ""
-        for offset, value in self.blocks.items():
-            info += "Offset=" + str(offset) + " "
-            info += value.__str__()
-            info += " "
-            into += "Download %: " + str(self.get_download_percent)
-        return info
+        received = sum(self.received) if self.received else 0
+        return f"Blocks received={received} Download %: {self.get_download_percent():.2f}"
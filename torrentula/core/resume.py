@@ -0,0 +1,119 @@
+import os
+import struct
+from ..utils.helpers import logger
+
+"""
+Resume file format (all integers big-endian):
+    magic        4 bytes   b"TRNT"
+    version      2 bytes
+    info_hash   20 bytes
+    piece count  4 bytes
+    data size    8 bytes   total size of the downloaded file(s) when the resume file was written
+    data mtime   8 bytes   latest modification time of the downloaded file(s) in nanoseconds
+    bitfield     ceil(piece count / 8) bytes, most significant bit first as in the BITFIELD message
+Version 2 appends a journal of partially downloaded pieces whose received blocks were written to the data file:
+    entry count  4 bytes
+    then for each entry:
+        piece index  4 bytes
+        block count  4 bytes
+        blocks       ceil(block count / 8) bytes, a bit per block set if the block is on disk, packed like the bitfield
+Version 1 files are still read, with an empty journal.
+"""
+
+RESUME_MAGIC = b"TRNT"
+RESUME_VERSION = 2
+HEADER = struct.Struct("!4sH20sIQQ")
+COUNT = struct.Struct("!I")
+ENTRY = struct.Struct("!II")
+
+
+def pack_bitfield(bitfield: list[int]) -> bytes:
+    packed = bytearray((len(bitfield) + 7) // 8)
+    for index, bit in enumerate(bitfield):
+        if bit:
+            packed[index // 8] |= 1 << (7 - index % 8)
+    return bytes(packed)
+
+
+def unpack_bitfield(packed: bytes, count: int) -> list[int]:
+    return [packed[index // 8] >> (7 - index % 8) & 1 for index in range(count)]
+
+
+def data_signature(paths) -> tuple[int, int]:
+    """
+    Returns the total size and latest modification time (ns) of the given files, used to detect data changed behind our back.
+    """
+    size = 0
+    mtime = 0
+    for path in paths:
+        stat = os.stat(path)
+        size += stat.st_size
+        mtime = max(mtime, stat.st_mtime_ns)
+    return size, mtime
+
+
+def write_resume_file(path, info_hash: bytes, bitfield: list[int], signature: tuple[int, int], journal: dict[int, bytes] = None):
+    """
+    Atomically replaces the resume file: it is written to a temporary file which is then renamed over the old one.
+    journal maps the index of each partially downloaded piece to one flag per block, set for blocks written to the data file.
+    """
+    journal = journal or {}
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(HEADER.pack(RESUME_MAGIC, RESUME_VERSION, info_hash, len(bitfield), *signature))
+        file.write(pack_bitfield(bitfield))
+        file.write(COUNT.pack(len(journal)))
+        for index, blocks in journal.items():
+            file.write(ENTRY.pack(index, len(blocks)))
+            file.write(pack_bitfield(blocks))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+def read_resume_file(path, info_hash: bytes, piece_count: int) -> tuple[list[int], tuple[int, int], dict[int, bytes]]:
+    """
+    Returns the bitfield, data signature and journal of partially downloaded pieces stored in a resume file.
+    Raises ValueError if the file is corrupt or belongs to another torrent.
+    Files in the original format (one ASCII digit per piece) are still accepted, without a signature.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    if not data.startswith(RESUME_MAGIC):
+        legacy = data.strip()
+        if len(legacy) != piece_count or legacy.strip(b"01"):
+            raise ValueError("unrecognized resume file format")
+        logger.info("Loaded progress from a resume file in the original text format.")
+        return [int(char) for char in legacy.decode()], None, {}
+    if len(data) < HEADER.size:
+        raise ValueError("truncated resume file header")
+    magic, version, stored_hash, count, size, mtime = HEADER.unpack_from(data)
+    if version not in (1, RESUME_VERSION):
+        raise ValueError(f"unsupported resume file version {version}")
+    if stored_hash != info_hash or count != piece_count:
+        raise ValueError("resume file belongs to a different torrent")
+    position = HEADER.size + (count + 7) // 8
+    if len(data) < position:
+        raise ValueError("truncated resume file bitfield")
+    bitfield = unpack_bitfield(data[HEADER.size : position], count)
+    if version == 1:
+        if len(data) != position:
+            raise ValueError("unexpected data after resume file bitfield")
+        return bitfield, (size, mtime), {}
+    try:
+        journal = {}
+        (entries,) = COUNT.unpack_from(data, position)
+        position += COUNT.size
+        for _ in range(entries):
+            index, blocks = ENTRY.unpack_from(data, position)
+            position += ENTRY.size
+            packed = data[position : position + (blocks + 7) // 8]
+            position += (blocks + 7) // 8
+            if len(packed) != (blocks + 7) // 8 or index >= count:
+                raise ValueError("corrupt resume file journal")
+            journal[index] = bytes(unpack_bitfield(packed, blocks))
+    except struct.error:
+        raise ValueError("truncated resume file journal")
+    if position != len(data):
+        raise ValueError("unexpected data after resume file journal")
+    return bitfield, (size, mtime), journal
@@ -0,0 +1,100 @@
+import hashlib
+import threading
+import time
+from queue import SimpleQueue, Empty
+from ..config import SCRUB_RATE_MB, SCRUB_YIELD_SECS, SCRUB_IDLE_SECS
+from ..utils.helpers import logger
+
+
+class Scrubber:
+    """
+    Verifies the pieces being seeded again on a background thread, so that data corrupted on disk stops being uploaded to the swarm.
+    Pieces are walked in order, starting over after the last one. Reads are throttled to rate bytes per second, and the scrubber
+    pauses for SCRUB_YIELD_SECS after a piece whenever uploads were served meanwhile, leaving the disk to them.
+    Corrupt pieces are reported through a queue that File drains from the event loop.
+    """
+
+    def __init__(self, file, rate=SCRUB_RATE_MB * 1_048_576):
+        self.file = file  # Read from the worker thread: storage, bitfield, pieces and hashes.
+        self.rate = rate
+        self.position = 0  # Index of the next piece to verify.
+        self.passes = 0  # Complete walks over the torrent.
+        self.pieces_checked = 0
+        self.bytes_checked = 0
+        self.started = time.monotonic()
+        self.uploading = False  # Set by File whenever a block is uploaded, cleared once the scrubber has yielded.
+        self.corrupt = SimpleQueue()  # Indices of pieces that failed verification.
+        self.reported = set()  # Pieces put on the corrupt queue, which are not checked again.
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="scrubber", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        count = len(self.file.pieces)
+        checked = 0  # Pieces verified during the current pass.
+        while not self.stopping.is_set():
+            index = self.position
+            delay = 0
+            if self.file.bitfield[index] and index not in self.reported:
+                start = time.monotonic()
+                length = self.file.pieces[index].length
+                valid = self.check(index, length)
+                if valid is not None:
+                    checked += 1
+                    self.pieces_checked += 1
+                    self.bytes_checked += length
+                    if not valid:
+                        self.reported.add(index)
+                        self.corrupt.put(index)
+                delay = length / self.rate - (time.monotonic() - start)
+            if self.uploading:
+                self.uploading = False
+                delay = max(delay, SCRUB_YIELD_SECS)
+            self.position = (index + 1) % count
+            if self.position == 0:
+                if checked:
+                    self.passes += 1
+                    logger.info(f"Scrubber finished pass {self.passes} over {count} pieces.")
+                else:  # No piece is left to verify, wait for pieces to be downloaded again instead of spinning.
+                    delay = max(delay, SCRUB_IDLE_SECS)
+                checked = 0
+            if delay > 0 and self.stopping.wait(delay):
+                return
+
+    def check(self, index, length):
+        """
+        Returns whether piece index matches its hash, or None if storage could not be read (it may have been closed or replaced).
+        """
+        try:
+            data = self.file.storage.read(index * self.file.piece_length, length)
+            return hashlib.sha1(data).digest() == self.file.hashes[index]
+        except (OSError, ValueError, AttributeError) as e:
+            logger.debug(f"Scrubber could not read piece {index}: {e}")
+            return None
+
+    def collect(self) -> list[int]:
+        """
+        Returns the pieces found corrupt since the last call.
+        """
+        corrupt = []
+        while True:
+            try:
+                corrupt.append(self.corrupt.get_nowait())
+            except Empty:
+                return corrupt
+
+    def progress(self) -> float:
+        """
+        Returns the percentage of the current pass that has been completed.
+        """
+        return self.position / len(self.file.pieces) * 100
+
+    def throughput(self) -> float:
+        """
+        Returns the average verification rate in MB/s since the scrubber started.
+        """
+        return self.bytes_checked / 1_048_576 / max(time.monotonic() - self.started, 1e-6)
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
@@ -0,0 +1,122 @@
+import os
+import sys
+import threading
+from queue import Queue, Full, Empty
+from .storage import SinkStorage
+from ..config import SINK_BUFFER_MB
+from ..utils.helpers import logger
+
+
+class OrderedSink:
+    """
+    Writes the torrent's data in order to stdout or a named pipe while it downloads, so that it can be piped straight into another program.
+    Each time the run of completed pieces at the start of the torrent grows, the new pieces are queued for a writer thread, so that a slow
+    reader never blocks the event loop. At most buffer bytes of pieces are queued; the rest wait until the queue drains.
+    With SinkStorage (--sink-only) pieces completed out of order are held in memory until they are written out, and once buffer bytes
+    are held only the pieces the sink needs next are started. Otherwise idle peers are offered the pieces in window() first.
+    """
+
+    def __init__(self, file, path, buffer=SINK_BUFFER_MB * 1_048_576, fd=None):
+        """
+        fd is the output already opened with open_output(path), which is opened here if None.
+        """
+        self.file = file
+        self.path = path  # "-" for stdout.
+        self.buffer = buffer
+        self.next = 0  # Index of the next piece to queue for writing.
+        self.bytes_written = 0
+        self.error = None  # Set by the writer thread if the output cannot be written, after which nothing more is written.
+        self.queue = Queue(maxsize=max(1, buffer // file.piece_length))  # Piece indices to write, None to stop.
+        self.fd = open_output(path) if fd is None else fd
+        self.thread = threading.Thread(target=self.run, name="sink-writer", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            index = self.queue.get()
+            if index is None:
+                return
+            if self.error:  # Keep draining the queue, so that advance() and stop() never block on it.
+                continue
+            offset = index * self.file.piece_length
+            try:
+                storage = self.file.storage
+                if isinstance(storage, SinkStorage):
+                    data = storage.release(offset)
+                    self.file.released.add(index)
+                else:
+                    data = bytes(storage.read(offset, self.file.pieces[index].length))
+                view = memoryview(data)
+                written = 0
+                while written < len(view):
+                    written += os.write(self.fd, view[written:])
+                self.bytes_written += len(data)
+            except (OSError, AttributeError) as e:  # A closed pipe, or storage that was closed meanwhile.
+                logger.error(f"Could not write piece {index} to {self.path}: {e}")
+                self.error = e
+
+    def advance(self, block=False) -> int:
+        """
+        Queues the pieces that have completed directly after those already queued, waiting for room in the queue if block is set.
+        Called from the event loop after the bitfield is updated. Returns the number of pieces queued.
+        """
+        queued = 0
+        while not self.error and self.next < len(self.file.bitfield) and self.file.bitfield[self.next]:
+            try:
+                self.queue.put(self.next, block=block)
+            except Full:
+                break
+            self.next += 1
+            queued += 1
+        return queued
+
+    def backlogged(self) -> bool:
+        """
+        Returns True if the pieces held for the sink have filled its buffer, in which case only the pieces in window() should be started.
+        """
+        storage = self.file.storage
+        return isinstance(storage, SinkStorage) and storage.held_bytes >= self.buffer
+
+    def window(self) -> set[int]:
+        """
+        Returns the indices of the pieces within buffer bytes of the next piece the sink needs.
+        """
+        return set(range(self.next, min(len(self.file.pieces), self.next + max(1, self.buffer // self.file.piece_length))))
+
+    def finish(self):
+        """
+        Writes out every completed piece that directly follows those already written, then closes the output.
+        """
+        self.advance(block=True)
+        if self.next < len(self.file.pieces) and not self.error:
+            logger.warning(f"Piece {self.next} was not downloaded, so only {self.next} of {len(self.file.pieces)} pieces were written to {self.path}.")
+        self.stop()
+
+    def stop(self, discard=False):
+        """
+        Stops the writer thread once the pieces already queued have been written, and closes the output.
+        If discard is set, queued pieces are dropped and the writer is not waited for, as it may be blocked on a pipe nobody reads.
+        """
+        if discard:
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except Empty:
+                    break
+        self.queue.put(None)
+        if not discard:
+            self.thread.join()
+        if not self.thread.is_alive():
+            os.close(self.fd)
+
+
+def open_output(path) -> int:
+    """
+    Opens the output of an OrderedSink and returns its fd. For stdout ("-") everything printed afterwards goes to stderr instead,
+    so it must be called before anything that may print, such as building the File.
+    """
+    if path == "-":
+        fd = os.dup(sys.stdout.fileno())
+        sys.stdout = sys.stderr  # Progress and messages must not end up in the piped data.
+        return fd
+    return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)  # Blocks until a reader opens the pipe.
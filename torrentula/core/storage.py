@@ -0,0 +1,431 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from .layout import Layout
+from .transfer import sendfile_some
+from ..config import PREALLOCATION_CHUNK_BYTES, MAX_OPEN_FILES
+from ..utils.helpers import logger
+
+# posix_fadvise advice by name, empty on platforms without it.
+FADVICE = {name: getattr(os, f"POSIX_FADV_{name.upper()}") for name in ("normal", "sequential", "willneed", "dontneed")} if hasattr(os, "posix_fadvise") else {}
+MAX_NULL_READ_BYTES = 2**20  # Reads from NullStorage up to this size share one buffer of zeros.
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") and "SC_IOV_MAX" in os.sysconf_names else 1024  # Most buffers a single pwritev accepts.
+
+
+class Storage:
+    """
+    Interface of the backends holding the data of a torrent, addressed by byte offset within the torrent. File and Piece only use these methods.
+    read and write may be called from several threads at once (see DiskWriter and Scrubber).
+    Backends holding data in a file descriptor may also provide sendfile(sock, offset, length), which uploads as much of a range as the
+    socket accepts without blocking, without copying it, and returns the number of bytes sent.
+    The modes of backends that keep nothing on disk are listed in VOLATILE_STORAGE_MODES, File keeps no resume file for them.
+    """
+
+    def read(self, offset, length):
+        """
+        Returns a bytes-like object holding length bytes at offset.
+        """
+        raise NotImplementedError
+
+    def write(self, offset, data):
+        raise NotImplementedError
+
+    def writev(self, offset, buffers):
+        """
+        Writes the buffers one after another starting at offset.
+        """
+        for data in buffers:
+            self.write(offset, data)
+            offset += len(data)
+
+    def advise(self, offset, length, advice):
+        """
+        Tells the backend how a range will be accessed (a key of FADVICE). Ignored unless the backend caches data from a file.
+        """
+
+    def size(self) -> int:
+        """
+        Returns the number of bytes the backend holds.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileStorage(Storage):
+    """
+    Stores torrent data in a regular file, accessed with positional reads and writes so that several threads can share it.
+    """
+
+    def __init__(self, path, readonly=False):
+        self.fd = os.open(path, os.O_RDONLY if readonly else os.O_RDWR)
+
+    def read(self, offset, length):
+        return os.pread(self.fd, length, offset)
+
+    def write(self, offset, data):
+        pwrite_all(self.fd, memoryview(data), offset)
+
+    def writev(self, offset, buffers):
+        pwritev_all(self.fd, buffers, offset)
+
+    def advise(self, offset, length, advice):
+        fadvise(self.fd, offset, length, advice)
+
+    def size(self) -> int:
+        return os.fstat(self.fd).st_size
+
+    def sendfile(self, sock, offset, length) -> int:
+        return sendfile_some(sock, self.fd, offset, length)
+
+    def flush(self):
+        os.fsync(self.fd)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MmapStorage(Storage):
+    """
+    Stores torrent data in a memory-mapped file.
+    Writes copy directly into the mapping and reads return memoryview slices of it, so no seek or read syscalls are issued per block.
+    """
+
+    def __init__(self, path, length, readonly=False):
+        self.file = open(path, "rb" if readonly else "rb+")
+        self.readonly = readonly
+        if os.fstat(self.file.fileno()).st_size < length and not readonly:
+            self.file.truncate(length)  # A mapping cannot extend past the end of the file.
+        access = mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE
+        self.mmap = mmap.mmap(self.file.fileno(), length, access=access)
+        self.view = memoryview(self.mmap)
+
+    def read(self, offset, length):
+        return self.view[offset : offset + length]
+
+    def write(self, offset, data):
+        self.view[offset : offset + len(data)] = data
+
+    def advise(self, offset, length, advice):
+        fadvise(self.file.fileno(), offset, length, advice)  # The mapping shares the file's page cache.
+
+    def size(self) -> int:
+        return len(self.mmap)
+
+    def flush(self):
+        if not self.mmap.closed and not self.readonly:
+            self.mmap.flush()
+
+    def close(self):
+        self.flush()
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:  # A peer upload still holds a slice of the mapping; it is unmapped once that is released.
+            logger.debug("Memory map still in use, deferring unmap.")
+        self.file.close()
+
+
+class MultiFileStorage(Storage):
+    """
+    Stores the data of a multi-file torrent across its files.
+    Reads and writes are split at file boundaries using the layout's span index and issued as positional I/O.
+    At most MAX_OPEN_FILES descriptors are kept open, evicting the least recently used, so torrents with thousands of small files do not exhaust them.
+    The lock is only held to look up descriptors, so several threads can read and write at once. A descriptor in use is never evicted.
+    """
+
+    def __init__(self, layout: Layout, root: Path, readonly=False):
+        self.layout = layout
+        self.paths = layout.paths(root)
+        self.readonly = readonly
+        self.flags = os.O_RDONLY if readonly else os.O_RDWR | os.O_CREAT
+        self.descriptors = OrderedDict()  # key = file index, value = open fd, least recently used first
+        self.users = {}  # key = file index, value = number of threads using its fd
+        self.lock = threading.Lock()  # Guards the descriptor cache and users.
+
+    @contextmanager
+    def descriptor(self, index):
+        """
+        Yields an open fd for file index, which is not closed until the block exits.
+        """
+        with self.lock:
+            fd = self.descriptors.get(index)
+            if fd is None:
+                self.evict()
+                fd = os.open(self.paths[index], self.flags, 0o644)
+                self.descriptors[index] = fd
+            else:
+                self.descriptors.move_to_end(index)
+            self.users[index] = self.users.get(index, 0) + 1
+        try:
+            yield fd
+        finally:
+            with self.lock:
+                self.users[index] -= 1
+                if not self.users[index]:
+                    del self.users[index]
+
+    def evict(self):
+        """
+        Closes the least recently used fd that no thread is using once MAX_OPEN_FILES are open. Called with the lock held.
+        """
+        if len(self.descriptors) < MAX_OPEN_FILES:
+            return
+        for index in self.descriptors:
+            if index not in self.users:
+                fd = self.descriptors.pop(index)
+                if not self.readonly:  # flush() only syncs the files still open.
+                    os.fsync(fd)
+                os.close(fd)
+                return
+        # Every fd is in use, the limit is exceeded until some are released.
+
+    def read(self, offset, length):
+        chunks = []
+        for index, file_offset, span in self.layout.spans(offset, length):
+            with self.descriptor(index) as fd:
+                chunks.append(os.pread(fd, span, file_offset))
+        return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+    def write(self, offset, data):
+        self.writev(offset, [data])
+
+    def writev(self, offset, buffers):
+        views = [memoryview(data) for data in buffers]
+        total = sum(len(view) for view in views)
+        current = 0  # Index into views of the buffer the next span starts in.
+        position = 0  # Offset of the next span within views[current].
+        for index, file_offset, span in self.layout.spans(offset, total):
+            # Gather the parts of the buffers that fall within this file, which are written by one pwritev.
+            parts = []
+            while span:
+                part = views[current][position : position + span]
+                parts.append(part)
+                span -= len(part)
+                position += len(part)
+                if position == len(views[current]):
+                    current += 1
+                    position = 0
+            with self.descriptor(index) as fd:
+                pwritev_all(fd, parts, file_offset)
+
+    def sendfile(self, sock, offset, length) -> int:
+        sent = 0
+        for index, file_offset, span in self.layout.spans(offset, length):
+            with self.descriptor(index) as fd:
+                count = sendfile_some(sock, fd, file_offset, span)
+            sent += count
+            if count < span:  # The socket's send buffer is full.
+                break
+        return sent
+
+    def advise(self, offset, length, advice):
+        for index, file_offset, span in self.layout.spans(offset, length):
+            with self.descriptor(index) as fd:
+                fadvise(fd, file_offset, span, advice)
+
+    def size(self) -> int:
+        return self.layout.length
+
+    def flush(self):
+        with self.lock:
+            for fd in self.descriptors.values():
+                os.fsync(fd)
+
+    def close(self):
+        with self.lock:
+            while self.descriptors:
+                _, fd = self.descriptors.popitem()
+                os.close(fd)
+
+
+def pwrite_all(fd, view: memoryview, offset):
+    """
+    Writes all of view at offset, since pwrite may write fewer bytes than requested.
+    """
+    written = 0
+    while written < len(view):
+        written += os.pwrite(fd, view[written:], offset + written)
+
+
+class MemoryStorage(Storage):
+    """
+    Keeps torrent data in memory, for tests and benchmarks that should not touch the disk. The data is lost when the process exits.
+    """
+
+    def __init__(self, length):
+        self.data = bytearray(length)
+
+    def read(self, offset, length):
+        return memoryview(self.data)[offset : offset + length]
+
+    def write(self, offset, data):
+        self.data[offset : offset + len(data)] = data
+
+    def size(self) -> int:
+        return len(self.data)
+
+
+class NullStorage(Storage):
+    """
+    Discards written data and reads back zeros, so that load tests and benchmarks measure the network and protocol alone.
+    Pieces are verified as they are downloaded, but uploads and rechecks see only zeros.
+    """
+
+    def __init__(self, length):
+        self.length = length
+        self.zeros = bytes(MAX_NULL_READ_BYTES)  # Reads up to this size are served from a single buffer.
+
+    def read(self, offset, length):
+        if length <= len(self.zeros):
+            return memoryview(self.zeros)[:length]
+        return bytes(length)
+
+    def write(self, offset, data):
+        pass
+
+    def size(self) -> int:
+        return self.length
+
+
+class SinkStorage(Storage):
+    """
+    Holds each verified piece in memory only until an OrderedSink has written it out, for downloads that are piped elsewhere instead of kept on disk.
+    Pieces are always written whole (see Piece and DiskWriter), so they are held by the offset they start at. Reads of released pieces fail.
+    """
+
+    def __init__(self, length, piece_length):
+        self.length = length
+        self.piece_length = piece_length
+        self.lock = threading.Lock()  # Guards held, filled by the disk writer threads and drained by the sink.
+        self.held = {}  # Offset of each written piece to a copy of its data.
+        self.held_bytes = 0
+
+    def read(self, offset, length):
+        start = offset - offset % self.piece_length
+        with self.lock:
+            data = self.held.get(start)
+        if data is None:
+            raise OSError(f"The piece at offset {start} is not held in memory")
+        return memoryview(data)[offset - start : offset - start + length]
+
+    def write(self, offset, data):
+        data = bytes(data)  # The piece buffer is reused once the write completes.
+        with self.lock:
+            self.held[offset] = data
+            self.held_bytes += len(data)
+
+    def release(self, offset) -> bytes:
+        """
+        Removes and returns the piece starting at offset.
+        """
+        with self.lock:
+            data = self.held.pop(offset)
+            self.held_bytes -= len(data)
+        return data
+
+    def size(self) -> int:
+        return self.length
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    Tells the kernel how a range of the file will be accessed (advice is a key of FADVICE). Does nothing where posix_fadvise is not available.
+    """
+    if FADVICE:
+        os.posix_fadvise(fd, offset, length, FADVICE[advice])
+
+
+def pwritev_all(fd, buffers, offset):
+    """
+    Writes the buffers one after another starting at offset, with a single pwritev where possible.
+    Falls back to one pwrite per buffer on platforms without pwritev.
+    """
+    if not hasattr(os, "pwritev"):
+        for data in buffers:
+            pwrite_all(fd, memoryview(data), offset)
+            offset += len(data)
+        return
+    views = [memoryview(data) for data in buffers if len(data)]
+    first = 0  # Index into views of the first buffer not completely written.
+    while first < len(views):
+        written = os.pwritev(fd, views[first : first + IOV_MAX], offset)
+        offset += written
+        while first < len(views) and written >= len(views[first]):
+            written -= len(views[first])
+            first += 1
+        if written:  # Partial write, continue from the middle of a buffer.
+            views[first] = views[first][written:]
+
+
+def open_storage(mode, layout: Layout, root: Path, readonly=False):
+    """
+    Opens the storage backend selected by mode for a torrent whose root file or directory is at root.
+    The "memory", "null" and "sink" backends keep nothing on disk and ignore root.
+    """
+    if mode == "sink":
+        return SinkStorage(layout.length, layout.piece_length)
+    if mode == "memory":
+        return MemoryStorage(layout.length)
+    if mode == "null":
+        return NullStorage(layout.length)
+    if layout.multi_file:
+        if mode == "mmap":
+            logger.info("Memory-mapped storage is only available for single-file torrents, using positional file I/O instead.")
+        return MultiFileStorage(layout, root, readonly)
+    if mode == "mmap":
+        return MmapStorage(root, layout.length, readonly)
+    return FileStorage(root, readonly)
+
+
+def preallocate(layout: Layout, root: Path, mode):
+    """
+    Creates every file of a new download at its full size according to the preallocation mode:
+        sparse: truncate each file to its final size, leaving unwritten regions as holes.
+        full: truncate, then reserve the disk blocks with posix_fallocate on a background thread.
+        legacy: write zeros over each file, one bounded chunk at a time.
+    Returns the background allocation thread, or None if allocation has already finished.
+    """
+    files = [(path, entry.length) for path, entry in zip(layout.paths(root), layout.files)]
+    for path, length in files:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as file:
+            if mode == "legacy":
+                zeros = bytes(min(PREALLOCATION_CHUNK_BYTES, length))
+                for offset in range(0, length, PREALLOCATION_CHUNK_BYTES):
+                    file.write(zeros[: min(PREALLOCATION_CHUNK_BYTES, length - offset)])
+            else:
+                file.truncate(length)
+
+    if mode == "full":
+        if not hasattr(os, "posix_fallocate"):
+            logger.info("posix_fallocate is not available on this platform, falling back to sparse preallocation.")
+            return None
+        # posix_fallocate never alters existing data, so pieces can be written while it runs.
+        thread = threading.Thread(target=_fallocate, args=(files,), daemon=True)
+        thread.start()
+        return thread
+    return None
+
+
+def _fallocate(files):
+    for path, length in files:
+        if length == 0:
+            continue
+        try:
+            fd = os.open(path, os.O_WRONLY)
+            try:
+                os.posix_fallocate(fd, 0, length)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.error(f"Could not preallocate {length} bytes for '{path}': {e}")
+            return
+    logger.info(f"Finished allocating {sum(length for _, length in files)} bytes on disk.")
@@ -1,6 +1,7 @@
 from .peer import Peer
 from random import choice
-from ..config import MIN_CONNECTED_PEERS, MAX_CONNECTED_PEERS, NUM_RAREST_PIECES
+import time
+from ..config import MIN_CONNECTED_PEERS, MAX_CONNECTED_PEERS, NUM_RAREST_PIECES, STREAM_DUPLICATE_PEERS
 from ..utils.helpers import logger
 
 """
@@ -9,6 +10,7 @@ Strategy Interface:
     def assign_pieces(self, remaining_pieces, peers: list[Peer])
     def send_haves(self, completed_pieces, actual_bitfield, peers)
     def determine_additional_peers(self, file, connected_peers: list[Peer]) -> int
+    def urgent_pieces(self) -> set[int]
 """
 
 
@@ -63,6 +65,23 @@ class Strategy:
         else:
             return 0
 
+    def urgent_pieces(self) -> set[int]:
+        """
+        Returns the pieces whose blocks may be requested from several peers at once, as in endgame mode.
+        """
+        return set()
+
+    @classmethod
+    def reassign(cls, peer: Peer, index):
+        """
+        Moves a peer to piece index, or releases it if index is None, cancelling its outstanding requests for the piece it worked on so that
+        they free its request slots.
+        """
+        if peer.target_piece is not None and peer.target_piece != index:
+            for request in set(peer.outgoing_requests):
+                peer.send_cancel(*request)
+        peer.target_piece = index
+
     @classmethod
     def get_top_four(cls, peers: list[Peer]) -> list[Peer]:
         """
@@ -102,8 +121,8 @@ class RarestFirstStrategy(Strategy):
         if not rarest_pieces_left:  # None of the peers have pieces we need.
             return
         for peer in unchoked_waiting_peers:
+            # A peer may have none of the given pieces, as pieces are offered one priority tier at a time.
             peer.target_piece = RarestFirstStrategy.choose_rarest_piece_with_randomness(rarest_pieces_left, peer)
-            assert peer.target_piece is not None, "Client should not be interested in a peer that has no desired pieces."
 
     # Helper methods
     @classmethod
@@ -133,6 +152,50 @@ class RarestFirstStrategy(Strategy):
         return [index for index, frequency in sorted_frequencies]  # Return the indices of the pieces
 
 
+class StreamingStrategy(RarestFirstStrategy):
+    """
+    Downloads the pieces just ahead of a streaming reader (see stream.Playhead) by their deadlines, and everything else rarest first.
+    A piece in the read-ahead window is assigned to the fastest idle peer that has it. Once overdue, it is assigned to the fastest peers
+    that have it, taking them off their current pieces, and its blocks are requested from all of them.
+    """
+
+    def __init__(self):
+        self.playhead = None  # Set by the client when its stream server starts.
+        self.urgent = set()
+
+    def assign_pieces(self, remaining_pieces, peers: list[Peer]):
+        if self.playhead:
+            self.assign_by_deadline(remaining_pieces, peers)
+        super().assign_pieces(remaining_pieces, peers)
+
+    def assign_by_deadline(self, remaining_pieces, peers: list[Peer]):
+        # Fastest first, by bytes received from them this epoch.
+        unchoked = sorted((peer for peer in peers if not peer.peer_choking and peer.am_interested), key=lambda peer: peer.bytes_received, reverse=True)
+        targeted = {peer.target_piece for peer in unchoked}
+        claimed = set()  # Peers taken by a piece with an earlier deadline.
+        now = time.monotonic()
+        for index, deadline in self.playhead.deadlines():
+            if index not in remaining_pieces:
+                continue
+            having = [peer for peer in unchoked if peer.bitfield[index] and peer not in claimed]
+            if deadline < now:
+                self.urgent.add(index)
+                for peer in having[:STREAM_DUPLICATE_PEERS]:
+                    Strategy.reassign(peer, index)
+                    claimed.add(peer)
+                targeted.add(index)
+            elif index not in targeted:
+                idle = [peer for peer in having if peer.target_piece is None]
+                if idle:
+                    idle[0].target_piece = index
+                    claimed.add(idle[0])
+                    targeted.add(index)
+
+    def urgent_pieces(self) -> set[int]:
+        urgent, self.urgent = self.urgent, set()  # Collected over the calls to assign_pieces since the last call.
+        return urgent
+
+
 class PropShareStrategy(Strategy):
     pass
 
@@ -143,8 +206,6 @@ class RandomStrategy(Strategy):
         remaining_pieces = list(remaining_pieces)
         if unchoked_peers:
             for peer in unchoked_peers:
-                while True:
-                    piece = choice(remaining_pieces)
-                    if peer.bitfield[piece]:
-                        peer.target_piece = piece
-                        break
+                having = [piece for piece in remaining_pieces if peer.bitfield[piece]]
+                if having:  # A peer may have none of the given pieces, as pieces are offered one priority tier at a time.
+                    peer.target_piece = choice(having)
@@ -0,0 +1,184 @@
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+from ..config import STREAM_READAHEAD_BYTES, STREAM_RATE_BYTES, STREAM_WAIT_SECS, STREAM_CHUNK_BYTES, LOOPBACK_IP
+from ..utils.helpers import logger
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)$")
+
+
+class Playhead:
+    """
+    Tracks where consumers of the stream are reading, so that the pieces just ahead of them can be given deadlines.
+    A piece is due when a reader consuming STREAM_RATE_BYTES per second from the last read position would reach it.
+    Updated from the HTTP server threads and read by the event loop; the position and its time are replaced together.
+    """
+
+    def __init__(self, piece_length, length, window=STREAM_READAHEAD_BYTES, rate=STREAM_RATE_BYTES):
+        self.piece_length = piece_length
+        self.length = length
+        self.window = window
+        self.rate = rate
+        self.state = None  # (byte offset of the last read, monotonic time of that read)
+
+    def seek(self, offset):
+        self.state = (offset, time.monotonic())
+
+    def deadlines(self) -> list[tuple[int, float]]:
+        """
+        Returns (piece index, monotonic deadline) for every piece within the read-ahead window, earliest first.
+        """
+        state = self.state
+        if state is None:
+            return []
+        position, since = state
+        first = position // self.piece_length
+        last = min(self.length - 1, position + self.window - 1) // self.piece_length
+        return [(index, since + max(0, index * self.piece_length - position) / self.rate) for index in range(first, last + 1)]
+
+
+class StreamServer:
+    """
+    Serves the torrent over HTTP on the loopback interface while it downloads, with support for Range requests.
+    Requests for data that has not been downloaded yet wait (up to STREAM_WAIT_SECS) for the pieces holding it, which the streaming picker prioritizes.
+    Single-file torrents are served at any path, the files of a multi-file torrent at their path within the torrent.
+    """
+
+    def __init__(self, file, port):
+        self.file = file
+        self.playhead = Playhead(file.piece_length, file.length)
+        self.available = threading.Condition()  # Notified by the event loop whenever pieces complete.
+        self.lock = threading.Lock()  # Guards active and last_active.
+        self.active = 0  # Requests being answered.
+        self.last_active = time.monotonic()  # When the last request ended, or the server started.
+        self.server = ThreadingHTTPServer((LOOPBACK_IP, port), StreamRequestHandler)
+        self.server.daemon_threads = True
+        self.server.stream = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name="stream-server", daemon=True)
+        self.thread.start()
+        logger.info(f"Streaming download at http://{LOOPBACK_IP}:{port}/")
+
+    def notify(self):
+        """
+        Wakes up requests waiting for pieces. Called from the event loop after pieces complete.
+        """
+        with self.available:
+            self.available.notify_all()
+
+    def resolve(self, path):
+        """
+        Returns the (torrent offset, length) of the file requested at the given URL path, or None if there is no such file.
+        """
+        layout = self.file.layout
+        if not layout.multi_file:
+            return 0, layout.length
+        requested = unquote(path.split("?")[0]).strip("/")
+        for entry in layout.files:
+            if entry.path.as_posix() == requested:
+                return entry.offset, entry.length
+        return None
+
+    def wait_for(self, offset, length) -> bool:
+        """
+        Blocks until the pieces covering the byte range are downloaded and storage is open. Returns False on timeout.
+        """
+        first = offset // self.file.piece_length
+        last = (offset + length - 1) // self.file.piece_length
+        deadline = time.monotonic() + STREAM_WAIT_SECS
+        with self.available:
+            while not (self.file.storage and all(self.file.bitfield[index] for index in range(first, last + 1))):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.available.wait(min(remaining, 1))  # Also polls, as storage is reopened without a notification.
+        return True
+
+    def begin_request(self):
+        with self.lock:
+            self.active += 1
+
+    def end_request(self):
+        with self.lock:
+            self.active -= 1
+            self.last_active = time.monotonic()
+
+    def idle_for(self) -> float:
+        """
+        Returns the seconds since the last request ended, or 0 while requests are being answered.
+        """
+        with self.lock:
+            return 0 if self.active else time.monotonic() - self.last_active
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StreamRequestHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        stream: StreamServer = self.server.stream
+        stream.begin_request()
+        try:
+            self.answer(stream, send_body)
+        finally:
+            stream.end_request()
+
+    def answer(self, stream: StreamServer, send_body):
+        resolved = stream.resolve(self.path)
+        if resolved is None:
+            self.send_error(404)
+            return
+        base, size = resolved
+        start, end = 0, size - 1
+        header = self.headers.get("Range")
+        if header:
+            match = RANGE_PATTERN.match(header.strip())
+            if not match or not any(match.groups()):
+                self.send_error(416)
+                return
+            first, last = match.groups()
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            else:  # Suffix range: the last bytes of the file.
+                start = max(0, size - int(last))
+            if start > end or start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(max(0, end - start + 1)))
+        self.end_headers()
+        if send_body:
+            self.send_range(stream, base + start, base + end + 1)
+
+    def send_range(self, stream: StreamServer, offset, stop):
+        while offset < stop:
+            length = min(STREAM_CHUNK_BYTES, stop - offset)
+            stream.playhead.seek(offset)
+            if not stream.wait_for(offset, length):
+                logger.info(f"Stream request timed out waiting for bytes {offset}-{offset + length - 1}.")
+                return
+            try:
+                self.wfile.write(stream.file.storage.read(offset, length))
+            except (OSError, ValueError, AttributeError) as e:  # Client went away, or storage was closed while reading.
+                logger.debug(f"Stream request ended: {e}")
+                return
+            offset += length
+
+    def log_message(self, format, *args):
+        logger.debug(f"Stream request: {format % args}")
@@ -0,0 +1,153 @@
+import os
+import time
+from collections import deque
+
+"""
+Zero-copy sending for peer uploads: payloads in memory are handed to sendmsg together with their message header, and payloads
+still on disk are sent straight from the storage file descriptor with os.sendfile, so uploaded data is never copied in userspace.
+Peer sockets are non-blocking and the event loop never waits for them: whatever a socket does not accept at once is queued (see SendQueue).
+"""
+
+MAX_SENDMSG_BUFFERS = 64  # Queued items handed to a single sendmsg, well below IOV_MAX.
+
+
+class StorageRegion:
+    """
+    A byte range of the torrent that is uploaded directly from storage with os.sendfile instead of being read into memory.
+    If its storage is closed before the region has been sent, detach() reads the rest of it into memory first.
+    """
+
+    def __init__(self, storage, offset, length):
+        self.storage = storage  # None once detached.
+        self.offset = offset
+        self.length = length
+        self.data = None  # The unsent bytes once detached.
+
+    def __len__(self):
+        return self.length
+
+    def send(self, sock) -> int:
+        """
+        Sends as much of the region as the socket accepts without blocking. Returns the number of bytes sent.
+        """
+        if self.data is None:
+            return self.storage.sendfile(sock, self.offset, self.length)
+        try:
+            return sock.send(self.data)
+        except BlockingIOError:
+            return 0
+
+    def consume(self, sent):
+        """
+        Drops the first sent bytes of the region, which the socket has accepted.
+        """
+        self.offset += sent
+        self.length -= sent
+        if self.data is not None:
+            self.data = self.data[sent:]
+
+    def detach(self):
+        """
+        Reads the unsent part of the region into memory, so that it no longer uses its storage.
+        """
+        if self.data is None:
+            self.data = memoryview(bytes(self.storage.read(self.offset, self.length)))
+            self.storage = None
+
+
+class SendQueue:
+    """
+    Data a peer's socket has not accepted yet, in order: bytes-like objects and StorageRegions.
+    Sends go straight to the socket while nothing is queued. What it does not accept is queued, copying payloads held in memory since
+    their buffers may be reused, and flush() sends more of it once per event loop iteration.
+    """
+
+    def __init__(self):
+        self.items = deque()
+        self.size = 0  # Bytes queued.
+        self.progress = time.monotonic()  # When the socket last accepted data, or the queue was last empty.
+
+    def send(self, sock, items):
+        """
+        Sends items after anything already queued, queuing the part the socket does not accept without blocking.
+        """
+        if self.items:
+            remaining = list(items)
+        else:
+            remaining = send_some(sock, list(items))
+            self.progress = time.monotonic()
+        for item in remaining:
+            item = item if isinstance(item, StorageRegion) else bytes(item)
+            self.items.append(item)
+            self.size += len(item)
+
+    def flush(self, sock) -> bool:
+        """
+        Sends as much of the queue as the socket accepts without blocking. Returns True once the queue is empty.
+        """
+        if not self.items:
+            return True
+        remaining = send_some(sock, list(self.items))
+        size = sum(len(item) for item in remaining)
+        if size < self.size:
+            self.progress = time.monotonic()
+        self.items = deque(remaining)
+        self.size = size
+        return not self.items
+
+    def stalled_for(self) -> float:
+        """
+        Returns the seconds for which queued data has not moved, or 0 if nothing is queued.
+        """
+        return time.monotonic() - self.progress if self.items else 0
+
+
+def send_some(sock, items) -> list:
+    """
+    Sends items in order, each run of in-memory items with a single sendmsg, until the socket would block.
+    Returns the items not sent, the first one cut down to its unsent part.
+    """
+    while items:
+        if isinstance(items[0], StorageRegion):
+            region = items[0]
+            sent = region.send(sock)
+            if sent < len(region):
+                region.consume(sent)
+                return items
+            items.pop(0)
+            continue
+        views = []
+        for item in items:
+            if isinstance(item, StorageRegion) or len(views) == MAX_SENDMSG_BUFFERS:
+                break
+            views.append(memoryview(item))
+        try:
+            sent = sock.sendmsg(views)
+        except BlockingIOError:
+            return items
+        partial = sent < sum(len(view) for view in views)
+        for view in views:
+            if sent < len(view):
+                break
+            sent -= len(view)
+            items.pop(0)
+        if partial:  # The socket's send buffer is full.
+            items[0] = memoryview(items[0])[sent:]
+            return items
+    return items
+
+
+def sendfile_some(sock, fd, offset, length) -> int:
+    """
+    Sends up to length bytes of the file fd starting at offset, as many as the socket accepts without blocking. Returns the number sent.
+    """
+    sent = 0
+    while sent < length:
+        try:
+            count = os.sendfile(sock.fileno(), fd, offset + sent, length - sent)
+        except BlockingIOError:
+            break
+        if count == 0:
+            raise EOFError("file ended before the requested range was sent")
+        sent += count
+    return sent
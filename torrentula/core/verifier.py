@@ -0,0 +1,90 @@
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from queue import SimpleQueue, Empty
+from ..config import HASH_WORKERS, DEFAULT_HASH_POOL
+from ..utils.helpers import logger
+
+
+def hash_piece(data, hasher=None):
+    """
+    Returns the SHA-1 digest of data and the seconds spent computing it. Runs inside a worker thread or process.
+    If hasher is given, data is the rest of a piece whose beginning has already been fed into hasher.
+    """
+    start = time.perf_counter()
+    hasher = hasher or hashlib.sha1()
+    hasher.update(data)
+    return hasher.digest(), time.perf_counter() - start
+
+
+class PieceVerifier:
+    """
+    Hashes completed pieces on a pool of worker threads or processes, keeping SHA-1 off the event loop.
+    hashlib releases the GIL for large buffers, so a thread pool already hashes on several cores; a process pool avoids the GIL entirely at the cost of copying each piece.
+    Digests are reported back through a queue that File drains once per event loop iteration.
+    """
+
+    def __init__(self, workers=HASH_WORKERS, pool=DEFAULT_HASH_POOL):
+        if pool == "process":
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hasher")
+        self.shares_memory = pool != "process"  # Workers can use memoryviews and running hash objects of pieces.
+        self.pending = set()  # Futures of pieces that have been submitted but not yet collected.
+        self.completed = SimpleQueue()  # (piece index, future) for each finished hash.
+        # Metrics
+        self.pieces_hashed = 0
+        self.bytes_hashed = 0
+        self.hash_seconds = 0  # Time spent hashing, summed over all workers.
+
+    def submit(self, index, data, hasher=None):
+        """
+        Queues the data of piece index to be hashed, continuing the running hash hasher if given (thread pools only).
+        """
+        future = self.executor.submit(hash_piece, data, hasher)
+        future.length = len(data)
+        self.pending.add(future)
+        future.add_done_callback(lambda done: self.completed.put((index, done)))
+
+    def collect(self) -> list[tuple[int, bytes]]:
+        """
+        Returns (piece index, digest) for every piece hashed since the last call. The digest is None if hashing failed.
+        """
+        results = []
+        while True:
+            try:
+                index, future = self.completed.get_nowait()
+            except Empty:
+                return results
+            self.pending.discard(future)
+            try:
+                digest, seconds = future.result()
+            except Exception as e:
+                logger.error(f"Hashing piece {index} failed: {e}")
+                results.append((index, None))
+                continue
+            self.pieces_hashed += 1
+            self.bytes_hashed += future.length
+            self.hash_seconds += seconds
+            results.append((index, digest))
+
+    def queue_depth(self) -> int:
+        """
+        Returns the number of pieces waiting to be hashed or waiting to be collected.
+        """
+        return len(self.pending)
+
+    def throughput(self) -> float:
+        """
+        Returns the hashing throughput of a single worker in MB/s.
+        """
+        return self.bytes_hashed / 1_048_576 / self.hash_seconds if self.hash_seconds else 0
+
+    def wait(self):
+        """
+        Blocks until every submitted piece has been hashed.
+        """
+        wait(list(self.pending))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
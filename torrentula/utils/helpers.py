@@ -2,7 +2,26 @@ import logging
 import argparse
 import os
 import sys
-from ..config import LOG_FILENAME, LOG_DIRECTORY, BITTORRENT_PORT, ENDGAME_THRESHOLD
+from ..config import (
+    LOG_FILENAME,
+    LOG_DIRECTORY,
+    BITTORRENT_PORT,
+    ENDGAME_THRESHOLD,
+    STORAGE_MODES,
+    DEFAULT_STORAGE_MODE,
+    PREALLOCATION_MODES,
+    DEFAULT_PREALLOCATION_MODE,
+    DISK_WRITE_WORKERS,
+    HASH_WORKERS,
+    HASH_POOL_TYPES,
+    DEFAULT_HASH_POOL,
+    RECHECK_MODES,
+    MEMORY_BUDGET_MB,
+    READ_CACHE_MB,
+    PAGE_CACHE_MB,
+    SCRUB_RATE_MB,
+    PRIORITY_LEVELS,
+)
 
 logger = logging.getLogger(LOG_FILENAME)
 
@@ -65,6 +84,17 @@ def parse_loopback_ports(value):
         raise argparse.ArgumentTypeError("Ports must be a comma-separated list of integers.")
 
 
+def parse_priority_range(value):
+    """
+    Parses LEVEL:START-END into (level, start, end), where end is None if omitted.
+    """
+    level, _, byte_range = value.partition(":")
+    start, _, end = byte_range.partition("-")
+    if level not in PRIORITY_LEVELS or not start.isdigit() or not (end.isdigit() or end == ""):
+        raise argparse.ArgumentTypeError(f"Priority ranges must look like LEVEL:START-END with LEVEL one of {', '.join(PRIORITY_LEVELS)}.")
+    return level, int(start), int(end) if end else None
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="A BitTorrent client to download a .torrent file from its distributed swarm.")
     parser.add_argument(
@@ -135,6 +165,100 @@ def parse_arguments():
         action="store_true",
         help="Include logs with console output (stderr).",
     )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGE_MODES,
+        default=DEFAULT_STORAGE_MODE,
+        help="How piece data is stored: 'file' (positional reads and writes), 'mmap' (memory-mapped, serves uploads without copying), "
+        "or for benchmarks 'memory' (kept in RAM) and 'null' (discarded, reads return zeros).",
+    )
+    parser.add_argument(
+        "--prealloc",
+        choices=PREALLOCATION_MODES,
+        default=DEFAULT_PREALLOCATION_MODE,
+        help="How a new download file is allocated: 'sparse' (instant), 'full' (posix_fallocate in the background) or 'legacy' (write zeros).",
+    )
+    parser.add_argument(
+        "--disk-workers",
+        type=int,
+        default=DISK_WRITE_WORKERS,
+        help="Number of threads writing verified pieces to disk in the background (0 writes them synchronously).",
+    )
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        default=HASH_WORKERS,
+        help="Number of workers verifying piece hashes in the background (0 hashes them on the event loop).",
+    )
+    parser.add_argument(
+        "--hash-pool",
+        choices=HASH_POOL_TYPES,
+        default=DEFAULT_HASH_POOL,
+        help="Whether piece hashes are verified on a pool of threads or processes.",
+    )
+    parser.add_argument(
+        "--recheck",
+        nargs="?",
+        const="full",
+        choices=RECHECK_MODES,
+        help="Verify data already on disk against the piece hashes before downloading. 'quick' only checks a sample of the pieces recorded as downloaded.",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=MEMORY_BUDGET_MB,
+        help="MB of partially downloaded pieces to hold in memory before no new pieces are started.",
+    )
+    parser.add_argument(
+        "--read-cache",
+        type=int,
+        default=READ_CACHE_MB,
+        help="MB of verified pieces cached in memory to serve uploads (0 reads every uploaded block from disk).",
+    )
+    parser.add_argument(
+        "--page-cache",
+        type=int,
+        default=PAGE_CACHE_MB,
+        help="MB of data served to peers left in the OS page cache before it is dropped, keeping the memory footprint of seeding stable.",
+    )
+    parser.add_argument(
+        "--scrub-rate",
+        type=int,
+        default=SCRUB_RATE_MB,
+        help="MB/s at which pieces are verified again in the background while seeding (0 disables it).",
+    )
+    parser.add_argument(
+        "--import-from",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="Before downloading, copy the pieces found in this file, or the files below this directory, such as an earlier release of the same data. Can be repeated.",
+    )
+    parser.add_argument(
+        "--stream",
+        type=int,
+        metavar="PORT",
+        help="Serve the download over HTTP on this local port while it progresses (with Range support), downloading the data ahead of readers first.",
+    )
+    parser.add_argument(
+        "--sink",
+        type=str,
+        metavar="PATH",
+        help="Write the data in order to this named pipe (or stdout if '-') as soon as it is downloaded, downloading the data it needs next first.",
+    )
+    parser.add_argument(
+        "--sink-only",
+        action="store_true",
+        help="With --sink, keep nothing on disk: downloaded pieces are only held in memory until they are written to the sink.",
+    )
+    parser.add_argument(
+        "--priority",
+        type=parse_priority_range,
+        action="append",
+        default=[],
+        metavar="LEVEL:START-END",
+        help=f"Set the download priority ({', '.join(PRIORITY_LEVELS)}) of bytes START up to END (exclusive) of the torrent, or to its end if END is omitted. Can be repeated, later ranges take precedence. Skipped data is not downloaded.",
+    )
     parser.add_argument(
         "--pref",
         type=str,
@@ -169,6 +293,8 @@ def parse_arguments():
         help="Set strategy to proportional share.",
     )
     args = parser.parse_args()
+    if args.sink_only and not args.sink:
+        parser.error("--sink-only requires --sink")
     logging.info(f"Parsed arguments: torr={args.torr}, dest={args.dest}")
     return args
 